@@ -1,25 +1,49 @@
+import hashlib
 import os
-from datetime import datetime
-import oauth2client
-from exchangelib import EWSTimeZone, EWSDateTime, AllProperties
-from exchangelib.folders import CalendarItem
+import threading
+from collections import namedtuple
+
+import arrow
+import oauth2client.file
 from googleapiclient.errors import HttpError
 from oauth2client import client
 from oauth2client import tools
 
+import throttling
+from state import SyncedEvent
+
 FIRST_CELL_MINUTES_AFTER_MIDNIGHT = 7 * 60
 
+# Each day tab is read in one request and sliced locally. Columns K:BF hold the 48 fifteen minute time blocks.
+SCHEDULE_RANGE = 'A1:CC100'
+TIME_BLOCK_FIRST_COLUMN = 10
+TIME_BLOCK_LAST_COLUMN = 57
+TIME_BLOCK_CELLS = TIME_BLOCK_LAST_COLUMN - TIME_BLOCK_FIRST_COLUMN + 1
+# Keeps batchGet URLs, which carry every range as a query parameter, well under Google's request size limits
+BATCH_GET_MAX_RANGES = 50
+
 SCOPES = ['https://www.googleapis.com/auth/calendar',
           'https://www.googleapis.com/auth/spreadsheets.readonly']
+# Only --watch asks Drive when the spreadsheet last changed
+WATCH_SCOPES = SCOPES + ['https://www.googleapis.com/auth/drive.metadata.readonly']
 
 CLIENT_SECRET_FILE = 'client_secret.json'
 APPLICATION_NAME = 'Frontline Calendar'
 LUNCH = "LUNCH"
 
+# Calendar event summaries for the appointment types that go on calendars
+SUMMARIES = {
+    'F': 'On Phones',
+    'C': 'On Chat',
+    LUNCH: 'Abby and Ali Lunch Date',
+}
+EVENT_DESCRIPTION = 'This event was created by Frontline Calendar. Contact Abby Lance with issues.'
+# Popup reminders, in minutes before an event starts
+REMINDER_MINUTES = [5, 0]
+
 
 class Range:
-    start = 0
-    end = 0
+    __slots__ = ('start', 'end')
 
     def __init__(self, start, end):
         self.start = start
@@ -50,224 +74,308 @@ class Range:
 
 
 class Appointment:
-    start_time = 0
-    end_time = 0
-    appointment_type = None
+    __slots__ = ('start_time', 'end_time', 'appointment_type', 'summary')
 
-    def __init__(self, start_time, end_time, appointment_type):
+    def __init__(self, start_time, end_time, appointment_type, summary=None):
         self.start_time = start_time
         self.end_time = end_time
         self.appointment_type = appointment_type
+        # overrides the calendar event summary of the appointment type
+        self.summary = summary
 
     def __repr__(self):
         return "{0}: {1} - {2}".format(self.appointment_type, self.start_time, self.end_time)
 
 
+# A run of consecutive time block cells of the same type, from start_cell up to but not including end_cell
+CellRun = namedtuple('CellRun', ['appointment_type', 'start_cell', 'end_cell'])
+
+
 def time_from_cell_index(index, day):
     minutes = FIRST_CELL_MINUTES_AFTER_MIDNIGHT + (index * 15)
     return day.replace(minutes=minutes)
 
 
 def appointment_summary(appointment):
-    summary = None
-    if appointment.appointment_type == 'F':
-        summary = 'On Phones'
-    elif appointment.appointment_type == 'C':
-        summary = 'On Chat'
-    elif appointment.appointment_type == LUNCH:
-        summary = 'Abby and Ali Lunch Date'
+    return appointment.summary or SUMMARIES.get(appointment.appointment_type)
+
+
+def tab_name(day):
+    return day.strftime("%a %m.%d.%y")
+
+
+# folds case and whitespace, so "abby  Lance " on a tab matches "Abby Lance" in a roster
+def normalize_name(name):
+    return ' '.join(name.split()).casefold()
+
+
+# normalized name -> rows of a day tab, built from the A:J name columns only
+class NameIndex:
+
+    def __init__(self, cells):
+        self.rows = {}
+        for row_index in range(0, len(cells)):
+            for value in cells[row_index][:TIME_BLOCK_FIRST_COLUMN]:
+                if not value:
+                    continue
+                rows = self.rows.setdefault(normalize_name(value), [])
+                if not rows or rows[-1] != row_index + 1:
+                    rows.append(row_index + 1)
+
+    def rows_for(self, name, aliases=()):
+        rows = set()
+        for candidate in [name] + list(aliases):
+            if candidate:
+                rows.update(self.rows.get(normalize_name(candidate), []))
+        return sorted(rows)
+
+
+# in-memory copy of the schedule spreadsheet, each day tab fetched at most once per run
+class SheetSnapshot:
+
+    # the most days worth prefetching at once, as many as a single batchGet can carry
+    PREFETCH_DAYS = BATCH_GET_MAX_RANGES
+
+    def __init__(self, service, spreadsheet_id):
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.tabs = {}
+        self.name_indexes = {}
+        self.index_lock = threading.Lock()
+        self.tab_titles = None
+        # one thread fetches tabs at a time, so a tab another thread is already fetching is never fetched twice
+        self.lock = threading.RLock()
+
+    # rows of the day tab as lists of cell values, or None if the tab could not be read
+    def cells(self, day):
+        tab = tab_name(day)
+        if tab not in self.tabs:
+            with self.lock:
+                if tab not in self.tabs:
+                    self.tabs[tab] = self._fetch(tab)
+        return self.tabs[tab]
+
+    def name_index(self, day):
+        tab = tab_name(day)
+        if tab not in self.name_indexes:
+            cells = self.cells(day)
+            # not self.lock, which the reader holds while it prefetches the next days
+            with self.index_lock:
+                if tab not in self.name_indexes:
+                    self.name_indexes[tab] = None if cells is None else NameIndex(cells)
+        return self.name_indexes[tab]
+
+    # missing tabs are marked unreadable up front, because one missing range fails a whole batchGet
+    def prefetch(self, days):
+        with self.lock:
+            self._prefetch([tab_name(day) for day in days])
+
+    def close(self):
+        # the Sheets service and its connections are shared with every other snapshot, so there is nothing to release
+        pass
+
+    def _prefetch(self, day_tabs):
+        tabs = []
+        for tab in day_tabs:
+            if tab not in self.tabs and tab not in tabs:
+                tabs.append(tab)
+        if not tabs:
+            return
+
+        existing_tabs = self._existing_tabs()
+        if existing_tabs is None:
+            # without the tab list we can't build a safe batch, cells() will fetch tabs one at a time instead
+            return
+
+        present_tabs = []
+        for tab in tabs:
+            if tab in existing_tabs:
+                present_tabs.append(tab)
+            else:
+                print("Could not find cells on spreadsheet in range {0}".format(self._range_name(tab)))
+                self.tabs[tab] = None
+
+        for i in range(0, len(present_tabs), BATCH_GET_MAX_RANGES):
+            self._batch_fetch(present_tabs[i:i + BATCH_GET_MAX_RANGES])
+
+    def _range_name(self, tab):
+        return "'{tab}'!{cells}".format(tab=tab, cells=SCHEDULE_RANGE)
+
+    def _existing_tabs(self):
+        if self.tab_titles is not None:
+            return self.tab_titles
+
+        try:
+            result = throttling.execute(self.service.spreadsheets().get(spreadsheetId=self.spreadsheet_id,
+                                                                        fields='sheets.properties.title'), 'sheets')
+        except HttpError:
+            print("Could not list the tabs of spreadsheet {0}".format(self.spreadsheet_id))
+            return None
+
+        self.tab_titles = set(sheet['properties']['title'] for sheet in result.get('sheets', []))
+        return self.tab_titles
+
+    def _batch_fetch(self, tabs):
+        ranges = [self._range_name(tab) for tab in tabs]
+
+        try:
+            # a batchGet counts as a single request against the Sheets quota
+            result = throttling.execute(self.service.spreadsheets().values().batchGet(
+                spreadsheetId=self.spreadsheet_id, ranges=ranges, majorDimension='ROWS'), 'sheets', items=len(ranges))
+        except HttpError:
+            # a tab may have been removed since we listed them, fall back to fetching this chunk tab by tab
+            for tab in tabs:
+                self.tabs[tab] = self._fetch(tab)
+            return
+
+        # value ranges come back in the order they were requested
+        for tab, value_range in zip(tabs, result.get('valueRanges', [])):
+            self.tabs[tab] = self._grid(self._range_name(tab), value_range)
+
+    def _fetch(self, tab):
+        range_name = self._range_name(tab)
+
+        try:
+            result = throttling.execute(self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id,
+                                                                                  range=range_name), 'sheets')
+        except HttpError:
+            print("Could not find cells on spreadsheet in range {0}".format(range_name))
+            return None
+
+        return self._grid(range_name, result)
+
+    def _grid(self, range_name, value_range):
+        if 'values' not in value_range:
+            print("Could not find cells on spreadsheet in range {0}".format(range_name))
+            return None
+
+        if 'majorDimension' not in value_range or value_range['majorDimension'] != 'ROWS':
+            print("majorDimension must be ROWS")
+            return None
+
+        return value_range.get('values', [])
+
+
+def row_for_name(snapshot, name, midnight, aliases=()):
+    return rows_for_names(snapshot, [name], midnight, {name: aliases}).get(name)
+
+
+# {name: row} of the names, or any of their aliases, found on the day tab, using the last row of duplicates
+def rows_for_names(snapshot, names, midnight, aliases=None):
+    index = snapshot.name_index(midnight)
+    rows = {}
+    if index is None:
+        return rows
+
+    aliases = aliases or {}
+    for name in names:
+        name_rows = index.rows_for(name, aliases.get(name, ()))
+        if len(name_rows) > 1:
+            print("Found {name} on rows {rows} on {date}, using row {row}".format(
+                name=name, rows=', '.join(str(row) for row in name_rows), date=tab_name(midnight), row=name_rows[-1]))
+        if name_rows:
+            rows[name] = name_rows[-1]
+
+    return rows
+
+
+# K:BF cells of a row, trimmed of trailing empty cells the way the Sheets API trims ranges
+def time_blocks_for_row(snapshot, row, midnight):
+    cells = snapshot.cells(midnight)
+    if cells is None or row > len(cells):
+        return []
+
+    time_blocks = cells[row - 1][TIME_BLOCK_FIRST_COLUMN:TIME_BLOCK_LAST_COLUMN + 1]
+    while time_blocks and time_blocks[-1] == '':
+        time_blocks = time_blocks[:-1]
+    return time_blocks
 
-    return summary
 
+def appointments_from_google_sheet(snapshot, row, midnight, appointment_types=None):
+    rangeName = "'{tab}'!K{row}:BF{row}".format(row=row, tab=tab_name(midnight))
 
-def row_for_name(service, spreadsheet_id, name, midnight):
-    range_name = "'{date}'!A1:CC100".format(date=midnight.strftime("%a %m.%d.%y"))
+    time_blocks = time_blocks_for_row(snapshot, row, midnight)
+    if not time_blocks:
+        print("Could not find cells on spreadsheet in range {0}".format(rangeName))
+        return []
 
-    try:
-        result = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=range_name).execute()
-    except HttpError:
-        print("Could not find cells on spreadsheet in range {0}".format(range_name))
-        return None
+    return appointments_from_time_blocks(time_blocks, midnight, appointment_types)
 
-    if 'values' not in result:
-        print("Could not find cells on spreadsheet in range {0}".format(range_name))
-        return None
 
-    if 'majorDimension' not in result or result['majorDimension'] != 'ROWS':
-        print("majorDimension must be ROWS")
-        return None
+def cell_runs(time_blocks):
+    runs = []
+    start = 0
+    for i in range(1, len(time_blocks) + 1):
+        if i == len(time_blocks) or time_blocks[i] != time_blocks[start]:
+            runs.append(CellRun(time_blocks[start], start, i))
+            start = i
+    return runs
 
-    cells = result.get('values', [])
-    row = None
-    for row_index in range(0, len(cells)):
-        row_cells = cells[row_index]
-        if name in row_cells:
-            row = row_index + 1
-            print("Found {name} on row {row} on {date}".format(name=name, row=row, date=midnight))
 
-    return row
+# datetimes are only made for kept runs, and a boundary shared by two runs only once
+def appointments_from_time_blocks(time_blocks, midnight, appointment_types=None):
+    times = {}
 
+    def time(index):
+        if index not in times:
+            times[index] = time_from_cell_index(index, midnight)
+        return times[index]
 
-def appointments_from_google_sheet(service, spreadsheet_id, row, midnight):
-    appointments = []
-    rangeName = "'{date}'!K{row}:BF{row}".format(row=row, date=midnight.strftime("%a %m.%d.%y"))
+    return [Appointment(time(run.start_cell), time(run.end_cell), run.appointment_type)
+            for run in cell_runs(time_blocks)
+            if appointment_types is None or run.appointment_type in appointment_types]
 
-    try:
-        result = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=rangeName).execute()
-    except HttpError:
-        print("Could not find cells on spreadsheet in range {0}".format(rangeName))
-        return appointments
 
-    if 'values' not in result:
-        print("Could not find cells on spreadsheet in range {0}".format(rangeName))
-        return appointments
-
-    time_blocks = result.get('values', [])
-    # shed outer list
-    if isinstance(time_blocks, list) and len(time_blocks) > 0 and isinstance(time_blocks[0], list):
-        time_blocks = time_blocks[0]
-
-    currentAppointment = None
-    for i in range(0, len(time_blocks)):
-        time_block_type = time_blocks[i]
-        # if there is an appointment in progress of the same type, extend it
-        if currentAppointment and currentAppointment.appointment_type == time_block_type:
-            currentAppointment.end_time = time_from_cell_index(i + 1, midnight)
-        # start a new appointment
-        else:
-            if currentAppointment:
-                appointments.append(currentAppointment)
-            currentAppointment = Appointment(time_from_cell_index(i, midnight), time_from_cell_index(i + 1, midnight),
-                                             time_block_type)
-
-    # clean up the last appointment
-    appointments.append(currentAppointment)
+# same person and appointment always give the same hex ID, which Google Calendar accepts as an event ID
+def appointment_event_id(person, appointment):
+    key = '{person}|{date}|{type}|{start}|{end}'.format(person=normalize_name(person),
+                                                        date=appointment.start_time.format('YYYY-MM-DD'),
+                                                        type=appointment.appointment_type,
+                                                        start=appointment.start_time.timestamp,
+                                                        end=appointment.end_time.timestamp)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
 
-    return appointments
 
+def synced_event(event_id, change_key, summary, appointment):
+    return SyncedEvent(event_id, change_key, summary, appointment.start_time.timestamp, appointment.end_time.timestamp)
 
-def create_google_calendar_events(appointments, google_calendar_service):
-    events_made = 0
-    for appointment in appointments:
-        summary = appointment_summary(appointment)
 
-        if summary:
-            if not google_calendar_event_exists(appointment, google_calendar_service, summary):
-                create_google_calendar_event(appointment, google_calendar_service, summary)
-            events_made += 1
-
-    return events_made
-
-
-def google_calendar_event_exists(appointment, calendar_service, summary):
-    matching_events = calendar_service.events().list(calendarId='primary',
-                                                     timeMin=appointment.start_time.datetime.isoformat(),
-                                                     timeMax=appointment.end_time.datetime.isoformat(),
-                                                     q=summary).execute()
-    if matching_events:
-        for matching_event in matching_events['items']:
-            if matching_event['start'] and matching_event['start']['dateTime'] and \
-                            matching_event['start']['dateTime'] == appointment.start_time.datetime.isoformat() and \
-                            matching_event['end'] and matching_event['end']['dateTime'] and \
-                            matching_event['end']['dateTime'] == appointment.end_time.datetime.isoformat():
-                print("Found matching Google Calendar event for appointment {app}. Will not create a new one.".format(app=appointment))
-                return True
-
-    return False
-
-
-def create_google_calendar_event(appointment, calendar_service, summary):
-    event = {
-        'summary': summary,
-        'start': {
-            'dateTime': appointment.start_time.datetime.isoformat()
-        },
-        'end': {
-            'dateTime': appointment.end_time.datetime.isoformat()
-        },
-        'reminders': {
-            'useDefault': False,
-            'overrides': [
-                {
-                    'method': 'popup',
-                    'minutes': '5'
-                },
-                {
-                    'method': 'popup',
-                    'minutes': '0'
-                }
-            ]
-        },
-        'description': 'This event was created by Frontline Calendar. Contact Abby Lance with issues.'
-    }
-
-    event = calendar_service.events().insert(calendarId='primary', body=event).execute()
-    print('Google Calendar event created. Link: {0} Details: {1}'.format(event.get('htmlLink'), event))
-
-
-def create_outlook_calendar_events(appointments, outlook_calendar_service):
-    events_made = 0
+# splits appointments into already synced, moves of recorded events, new ones, and stale recorded events
+def diff_synced_events(appointments, recorded_events):
+    recorded = dict((calendar_event_key(event.summary, event.start, event.end), event) for event in recorded_events)
+    synced = {}
+    unmatched = []
     for appointment in appointments:
         summary = appointment_summary(appointment)
+        if not summary:
+            continue
 
-        if summary:
-            if not outlook_calendar_event_exists(appointment, outlook_calendar_service, summary):
-                create_outlook_calendar_event(appointment, outlook_calendar_service, summary)
-            events_made += 1
-
-    return events_made
-
-
-def outlook_calendar_event_exists(appointment, calendar_service, summary):
-    ews_tz = EWSTimeZone.timezone('America/Chicago')
-
-    d = appointment.start_time.datetime
-    start_date_time = datetime(d.year, d.month, d.day, d.hour, d.minute, d.second, d.microsecond, ews_tz)
-    start_ews_date_time = EWSDateTime.from_datetime(start_date_time)
-
-    d = appointment.end_time.datetime
-    end_date_time = datetime(d.year, d.month, d.day, d.hour, d.minute, d.second, d.microsecond, ews_tz)
-    end_ews_date_time = EWSDateTime.from_datetime(end_date_time)
-
-    matching_events = calendar_service.calendar.find_items(
-        start=start_ews_date_time,
-        end=end_ews_date_time,
-        shape=AllProperties)
-
-    if matching_events:
-        for event in matching_events:
-            if event.subject == summary:
-                print(
-                    "Found a matching Outlook calendar event for appointment {app}. Will not create a new one.".format(
-                        app=appointment))
-                return True
-
-    return False
-
-
-def create_outlook_calendar_event(appointment, calendar_service, summary):
-    ews_tz = EWSTimeZone.timezone('America/Chicago')
-
-    d = appointment.start_time.datetime
-    start_date_time = datetime(d.year, d.month, d.day, d.hour, d.minute, d.second, d.microsecond, ews_tz)
-    start_ews_date_time = EWSDateTime.from_datetime(start_date_time)
+        key = calendar_event_key(summary, appointment.start_time, appointment.end_time)
+        if key in recorded:
+            synced[appointment] = recorded.pop(key)
+        else:
+            unmatched.append((appointment, summary))
+
+    stale = list(recorded.values())
+    moves = []
+    new = []
+    for appointment, summary in unmatched:
+        movable = [event for event in stale if event.summary == summary]
+        if movable:
+            stale.remove(movable[0])
+            moves.append((movable[0], appointment, summary))
+        else:
+            new.append((appointment, summary))
 
-    d = appointment.end_time.datetime
-    end_date_time = datetime(d.year, d.month, d.day, d.hour, d.minute, d.second, d.microsecond, ews_tz)
-    end_ews_date_time = EWSDateTime.from_datetime(end_date_time)
+    return synced, moves, new, stale
 
-    event = CalendarItem(
-        subject=summary,
-        body='This event was created by Frontline Calendar. Contact Abby Lance with issues.',
-        start=start_ews_date_time,
-        end=end_ews_date_time
-    )
 
-    calendar_service.calendar.add_items([event])
-    print('Outlook calendar event created. Details: {0}'.format(event))
+def calendar_event_key(summary, start_time, end_time):
+    # compare instants rather than ISO strings so events stored with a different UTC offset still match
+    return summary, arrow.get(start_time).timestamp, arrow.get(end_time).timestamp
 
 
-def get_credentials(flags):
+def get_credentials(flags, scopes=SCOPES):
     home_dir = os.path.expanduser('~')
     credential_dir = os.path.join(home_dir, '.credentials')
     if not os.path.exists(credential_dir):
@@ -276,8 +384,11 @@ def get_credentials(flags):
 
     store = oauth2client.file.Storage(credential_path)
     credentials = store.get()
-    if not credentials or credentials.invalid:
-        flow = client.flow_from_clientsecrets(CLIENT_SECRET_FILE, SCOPES)
+    # credentials stored by runs that needed fewer scopes have to be authorized again for the rest. Credentials stored
+    # by older versions don't record their scopes at all, so only scopes beyond SCOPES are checked.
+    extra_scopes = [scope for scope in scopes if scope not in SCOPES]
+    if not credentials or credentials.invalid or (extra_scopes and not credentials.has_scopes(extra_scopes)):
+        flow = client.flow_from_clientsecrets(CLIENT_SECRET_FILE, scopes)
         flow.user_agent = APPLICATION_NAME
         flags.noauth_local_webserver = True
         credentials = tools.run_flow(flow, store, flags)
@@ -0,0 +1,92 @@
+from appointments import FIRST_CELL_MINUTES_AFTER_MIDNIGHT, TIME_BLOCK_CELLS, rows_for_names, time_blocks_for_row
+from metrics import recorder, date_label
+
+# Availability is worked out on bitmasks over a day's time block cells: bit i stands for the 15 minute cell i, which
+# starts FIRST_CELL_MINUTES_AFTER_MIDNIGHT + 15 * i minutes after midnight. Everyone's busy cells are OR-ed together
+# in one pass, so finding common free time costs the same for two people as for twenty.
+CELL_MINUTES = 15
+
+BLOCKING_TYPES = ['F', 'C', 'PTO']
+# Lunch hours to look for common free time in, and the shortest free time worth scheduling, in hours
+LUNCH_EARLIEST = 11.0
+LUNCH_LATEST = 16.0
+LUNCH_MIN_HOURS = 1.5
+
+
+def cell_index_from_fractional_hour(fractional):
+    cell = int(round((fractional * 60 - FIRST_CELL_MINUTES_AFTER_MIDNIGHT) / CELL_MINUTES))
+    return min(max(cell, 0), TIME_BLOCK_CELLS)
+
+
+def busy_mask(time_blocks, blocking_types):
+    mask = 0
+    for i in range(0, len(time_blocks)):
+        if time_blocks[i] in blocking_types:
+            mask |= 1 << i
+    return mask
+
+
+def window_mask(first_cell, end_cell):
+    """
+    Mask with the cells from first_cell up to, but not including, end_cell set.
+    """
+    if end_cell <= first_cell:
+        return 0
+    return ((1 << (end_cell - first_cell)) - 1) << first_cell
+
+
+def free_runs(free_mask, min_cells):
+    """
+    Returns the (start_cell, end_cell) runs of consecutive set bits in free_mask that are at least min_cells long.
+    """
+    runs = []
+    while free_mask:
+        start = (free_mask & -free_mask).bit_length() - 1
+        shifted = free_mask >> start
+        # adding one to a run of trailing ones carries past it, leaving a single bit just above the run
+        length = (~shifted & (shifted + 1)).bit_length() - 1
+        if length >= min_cells:
+            runs.append((start, start + length))
+        free_mask &= ~window_mask(start, start + length)
+    return runs
+
+
+def common_free_runs(snapshot, names, dates, blocking_types=BLOCKING_TYPES, earliest=LUNCH_EARLIEST,
+                     latest=LUNCH_LATEST, min_hours=LUNCH_MIN_HOURS):
+    """
+    Finds the time everyone in names is free on each date, between the earliest and latest fractional hours, in runs
+    of at least min_hours. A cell is busy for a person if its type is one of blocking_types. Returns (date, runs)
+    pairs in date order with runs as (start_cell, end_cell) tuples, leaving out dates on which someone has no schedule
+    yet.
+    """
+    window = window_mask(cell_index_from_fractional_hour(earliest), cell_index_from_fractional_hour(latest))
+    min_cells = int(round(min_hours * 60 / CELL_MINUTES))
+    blocking_types = set(blocking_types)
+
+    free = []
+    for date in dates:
+        with recorder.phase('availability', date_label([date])):
+            rows = rows_for_names(snapshot, names, date)
+            missing = [name for name in names if name not in rows]
+            if missing:
+                print("Could not find row for {names} on {date}, will skip to next day".format(
+                    names=', '.join(missing), date=date))
+                continue
+
+            busy = 0
+            scheduled = True
+            for name in names:
+                time_blocks = time_blocks_for_row(snapshot, rows[name], date)
+                if not time_blocks:
+                    scheduled = False
+                    break
+                busy |= busy_mask(time_blocks, blocking_types)
+
+            # if someone has no appointments, don't try to schedule around them
+            if not scheduled:
+                print("No schedule yet defined for {0}".format(date))
+                continue
+
+            free.append((date, free_runs(window & ~busy, min_cells)))
+
+    return free
@@ -0,0 +1,509 @@
+"""
+Offline benchmark for frontline_calendar.py and lunchtime.py.
+
+Runs either script end to end against in-process stand-ins for the Sheets and Calendar discovery services and for an
+Exchange account, with a synthetic schedule of many names and days. Reports wall time, API calls per endpoint and peak
+memory so regressions in request counts show up before they hit real quotas. For example:
+
+    python benchmark.py --script frontline_calendar --names 20 --days 60 --google_calendar --outlook_calendar --runs 2
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from collections import Counter
+
+import arrow
+import httplib2
+from exchangelib.errors import ErrorItemNotFound, ErrorServerBusy
+from exchangelib.services import TNS
+from googleapiclient.errors import HttpError
+
+import frontline_calendar
+import google_services
+import lunchtime
+import metrics
+import outlook_calendar
+import throttling
+from appointments import TIME_BLOCK_FIRST_COLUMN, tab_name
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where peak memory is not reported
+    resource = None
+
+SPREADSHEET_ID = 'benchmark-spreadsheet'
+TIME_BLOCK_TYPES = ['F', 'F', 'C', '', '', 'PTO']
+
+
+class Backend:
+    """
+    Shared behaviour of the stand-in services: counts calls per endpoint, sleeps for the configured latency and fails
+    a fraction of calls with the backend's quota error.
+    """
+
+    def __init__(self, latency, quota_error_rate, seed):
+        self.latency = latency
+        self.quota_error_rate = quota_error_rate
+        self.calls = Counter()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def call(self, endpoint, quota_error=None):
+        with self.lock:
+            self.calls[endpoint] += 1
+            throttled = quota_error is not None and self.random.random() < self.quota_error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise quota_error()
+
+
+def google_quota_error():
+    return HttpError(httplib2.Response({'status': 429}), b'Rate Limit Exceeded')
+
+
+def exchange_quota_error():
+    return ErrorServerBusy('The server cannot service this request right now. Try again later.')
+
+
+class FakeRequest:
+    def __init__(self, backend, endpoint, function):
+        self.backend = backend
+        self.endpoint = endpoint
+        self.function = function
+        self.methodId = endpoint
+        self.resumable = None
+
+    def execute(self, http=None, num_retries=0):
+        self.backend.call(self.endpoint, google_quota_error)
+        return self.function()
+
+
+def synthetic_schedule(names, dates, seed):
+    """
+    Builds {tab name: rows} with a header row and one row per name, each with a random run of shift blocks.
+    """
+    rng = random.Random(seed)
+    tabs = {}
+    for date in dates:
+        rows = [['Name'] + [''] * (TIME_BLOCK_FIRST_COLUMN - 1) + ['{0}:00'.format(7 + i // 4) for i in range(0, 48)]]
+        for name in names:
+            time_blocks = []
+            while len(time_blocks) < 48:
+                time_blocks.extend([rng.choice(TIME_BLOCK_TYPES)] * rng.randint(2, 8))
+            rows.append([name] + [''] * (TIME_BLOCK_FIRST_COLUMN - 1) + time_blocks[:48])
+        tabs[tab_name(date)] = rows
+    return tabs
+
+
+class FakeSheetsService:
+    def __init__(self, backend, tabs):
+        self.backend = backend
+        self.tabs = tabs
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId, range=None, fields=None):
+        if fields is not None:
+            return FakeRequest(self.backend, 'sheets.spreadsheets.get',
+                               lambda: {'sheets': [{'properties': {'title': tab}} for tab in self.tabs]})
+        return FakeRequest(self.backend, 'sheets.spreadsheets.values.get', lambda: self._value_range(range))
+
+    def batchGet(self, spreadsheetId, ranges, majorDimension='ROWS'):
+        return FakeRequest(self.backend, 'sheets.spreadsheets.values.batchGet',
+                           lambda: {'valueRanges': [self._value_range(range_name) for range_name in ranges]})
+
+    def _value_range(self, range_name):
+        tab = range_name.split('!')[0].strip("'")
+        if tab not in self.tabs:
+            raise HttpError(httplib2.Response({'status': 400}), b'Unable to parse range')
+        return {'range': range_name, 'majorDimension': 'ROWS', 'values': self.tabs[tab]}
+
+
+class FakeBatch:
+    def __init__(self, backend, callback):
+        self.backend = backend
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        self.backend.call('calendar.batch', google_quota_error)
+        for request_id, request in self.requests:
+            with self.backend.lock:
+                self.backend.calls[request.endpoint] += 1
+                throttled = self.backend.random.random() < self.backend.quota_error_rate
+            if throttled:
+                self.callback(request_id, None, google_quota_error())
+                continue
+            try:
+                response = request.function()
+            except HttpError as error:
+                self.callback(request_id, None, error)
+                continue
+            self.callback(request_id, response, None)
+
+
+class FakeCalendarService:
+    """
+    Google Calendar stand-in keeping events per calendar ID in memory. Like Google, it keeps deleted events as
+    cancelled, so their IDs can't be inserted again.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.calendars = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def events(self):
+        return self
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.backend, callback)
+
+    def list(self, calendarId, timeMin, timeMax, singleEvents=True, maxResults=250, pageToken=None):
+        def page():
+            time_min, time_max = arrow.get(timeMin), arrow.get(timeMax)
+            with self.lock:
+                events = [event for event in self.calendars.get(calendarId, {}).values()
+                          if event.get('status') != 'cancelled' and
+                          arrow.get(event['start']['dateTime']) < time_max and
+                          arrow.get(event['end']['dateTime']) > time_min]
+            offset = int(pageToken or 0)
+            response = {'items': events[offset:offset + maxResults]}
+            if offset + maxResults < len(events):
+                response['nextPageToken'] = str(offset + maxResults)
+            return response
+
+        request = FakeRequest(self.backend, 'calendar.events.list', page)
+        request.list_arguments = (calendarId, timeMin, timeMax, singleEvents, maxResults)
+        return request
+
+    def list_next(self, previous_request, previous_response):
+        if 'nextPageToken' not in previous_response:
+            return None
+        return self.list(*previous_request.list_arguments, pageToken=previous_response['nextPageToken'])
+
+    def insert(self, calendarId, body):
+        def insert():
+            with self.lock:
+                event = dict(body)
+                if 'id' not in event:
+                    self.next_id += 1
+                    event['id'] = 'event{0}'.format(self.next_id)
+                calendar = self.calendars.setdefault(calendarId, {})
+                if event['id'] in calendar:
+                    raise HttpError(httplib2.Response({'status': 409}), b'The requested identifier already exists.')
+                calendar[event['id']] = event
+                return event
+
+        return FakeRequest(self.backend, 'calendar.events.insert', insert)
+
+    def get(self, calendarId, eventId):
+        def get():
+            with self.lock:
+                event = self.calendars.get(calendarId, {}).get(eventId)
+                if event is None:
+                    raise HttpError(httplib2.Response({'status': 404}), b'Not Found')
+                return dict(event)
+
+        return FakeRequest(self.backend, 'calendar.events.get', get)
+
+    def update(self, calendarId, eventId, body):
+        def update():
+            with self.lock:
+                event = dict(body, id=eventId)
+                self.calendars.setdefault(calendarId, {})[eventId] = event
+                return event
+
+        return FakeRequest(self.backend, 'calendar.events.update', update)
+
+    def delete(self, calendarId, eventId):
+        def delete():
+            with self.lock:
+                event = self.calendars.get(calendarId, {}).get(eventId)
+                if event is None or event.get('status') == 'cancelled':
+                    raise HttpError(httplib2.Response({'status': 410}), b'Resource has been deleted')
+                event['status'] = 'cancelled'
+                return ''
+
+        return FakeRequest(self.backend, 'calendar.events.delete', delete)
+
+    def event_count(self):
+        return sum(1 for calendar in self.calendars.values() for event in calendar.values()
+                   if event.get('status') != 'cancelled')
+
+
+class FakeExchangeCalendar:
+    """
+    Exchange calendar folder stand-in keeping items in memory as {item ID: item}.
+    """
+
+    def __init__(self, account, backend):
+        self.account = account
+        self.backend = backend
+        self.items = {}
+        self.next_id = 0
+
+    def add_items(self, items):
+        self.backend.call('exchange.add_items', exchange_quota_error)
+        ids = []
+        with self.backend.lock:
+            for item in items:
+                self.next_id += 1
+                item_id = '{0}-{1}'.format(self.account.primary_smtp_address, self.next_id)
+                self.items[item_id] = item
+                ids.append((item_id, 'changekey'))
+        return ids
+
+    def update_items(self, items):
+        self.backend.call('exchange.update_items', exchange_quota_error)
+        ids = []
+        with self.backend.lock:
+            for (item_id, change_key), changes in items:
+                if item_id not in self.items:
+                    raise ErrorItemNotFound(item_id)
+                for field, value in changes.items():
+                    setattr(self.items[item_id], field, value)
+                ids.append((item_id, change_key))
+        return ids
+
+    def delete_items(self, ids):
+        self.backend.call('exchange.delete_items', exchange_quota_error)
+        with self.backend.lock:
+            for item_id, change_key in ids:
+                if self.items.pop(item_id, None) is None:
+                    raise ErrorItemNotFound(item_id)
+
+    def find_items_xml(self):
+        elements = []
+        with self.backend.lock:
+            for item_id, item in self.items.items():
+                element = ElementTree.Element('{%s}CalendarItem' % TNS)
+                ElementTree.SubElement(element, '{%s}ItemId' % TNS, Id=item_id, ChangeKey='changekey')
+                ElementTree.SubElement(element, '{%s}Subject' % TNS).text = item.subject
+                for field in ('start', 'end'):
+                    value = arrow.get(getattr(item, field)).to('UTC').format('YYYY-MM-DDTHH:mm:ss') + 'Z'
+                    ElementTree.SubElement(element, '{%s}%s' % (TNS, field.capitalize())).text = value
+                elements.append(element)
+        return elements
+
+
+class FakeExchange:
+    """
+    Stands in for exchangelib: FakeExchange.Account and FakeExchange.Protocol replace exchangelib's Account and
+    Protocol, and FakeExchange.FindItem replaces the FindItem service the Outlook sink searches calendars with.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.calendars = {}
+        exchange = self
+
+        class Protocol:
+            def __init__(self, service_endpoint, credentials, auth_type, verify_ssl):
+                self.service_endpoint = service_endpoint
+                self.auth_type = auth_type
+
+        class Account:
+            def __init__(self, primary_smtp_address, credentials=None, autodiscover=False, access_type=None,
+                         config=None):
+                if autodiscover:
+                    exchange.backend.call('exchange.autodiscover')
+                    self.protocol = Protocol('https://exchange.example.com/EWS/Exchange.asmx', credentials, 'NTLM',
+                                             True)
+                else:
+                    self.protocol = config.protocol
+                self.primary_smtp_address = primary_smtp_address
+                if primary_smtp_address not in exchange.calendars:
+                    exchange.calendars[primary_smtp_address] = FakeExchangeCalendar(self, exchange.backend)
+                self.calendar = exchange.calendars[primary_smtp_address]
+
+        class FindItem:
+            def __init__(self, protocol):
+                pass
+
+            def call(self, folder, **kwargs):
+                exchange.backend.call('exchange.find_items', exchange_quota_error)
+                return folder.find_items_xml()
+
+        self.Protocol = Protocol
+        self.Account = Account
+        self.FindItem = FindItem
+
+    def event_count(self):
+        return sum(len(calendar.items) for calendar in self.calendars.values())
+
+
+class FakeCredentials:
+    def authorize(self, http):
+        return http
+
+
+def patch(module, name, value, patches):
+    patches.append((module, name, getattr(module, name)))
+    setattr(module, name, value)
+
+
+def run_script(flags, script_args, sheets, calendar, exchange, work_dir):
+    """
+    Runs the chosen script's main() once against the stand-ins and returns its wall time in seconds.
+    """
+    def build(service_name, version, http):
+        return sheets if service_name == 'sheets' else calendar
+
+    patches = []
+    script = frontline_calendar if flags.script == 'frontline_calendar' else lunchtime
+    patch(google_services, 'build', build, patches)
+    patch(script, 'get_credentials', lambda script_flags, scopes=None: FakeCredentials(), patches)
+    patch(outlook_calendar, 'Protocol', exchange.Protocol, patches)
+    patch(outlook_calendar, 'Account', exchange.Account, patches)
+    patch(outlook_calendar, 'FindItem', exchange.FindItem, patches)
+    patch(outlook_calendar, 'autodiscover_cache',
+          outlook_calendar.AutodiscoverCache(os.path.join(work_dir, 'autodiscover.json')), patches)
+
+    argv, stdout = sys.argv, sys.stdout
+    sys.argv = [flags.script + '.py'] + script_args
+    if not flags.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    started = time.time()
+    try:
+        script.main()
+    finally:
+        elapsed = time.time() - started
+        if not flags.verbose:
+            sys.stdout.close()
+        sys.argv, sys.stdout = argv, stdout
+        for module, name, value in reversed(patches):
+            setattr(module, name, value)
+
+    return elapsed
+
+
+def peak_memory_kilobytes():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark frontline_calendar.py or lunchtime.py offline.')
+    parser.add_argument('--script', choices=['frontline_calendar', 'lunchtime'], default='frontline_calendar')
+    parser.add_argument('--names', type=int, default=10, help='How many people are on the synthetic schedule?')
+    parser.add_argument('--days', type=int, default=30, help='How many days to look ahead?')
+    parser.add_argument('--lunch_names', type=int, default=2, help='How many people lunchtime.py schedules for')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='How many times to run the script against the same calendars and state')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds every fake API call takes')
+    parser.add_argument('--quota_error_rate', type=float, default=0.0,
+                        help='Fraction of fake API calls that fail with a quota error')
+    parser.add_argument('--rate_limits', action='store_true',
+                        help="Keep the real per-backend rate limits instead of lifting them")
+    parser.add_argument('--backoff_seconds', type=float, default=0.01,
+                        help='Base retry backoff, shortened from the real one by default')
+    parser.add_argument('--google_calendar', action='store_true')
+    parser.add_argument('--outlook_calendar', action='store_true')
+    parser.add_argument('--ics', action='store_true', help='Have frontline_calendar.py write .ics files too')
+    parser.add_argument('--metrics', help="Also have the script write its own --metrics report to this file on each "
+                                          "run, with the run number appended to the file name")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    parser.add_argument('--verbose', action='store_true', help="Show the script's own output")
+    flags = parser.parse_args()
+
+    if not (flags.google_calendar or flags.outlook_calendar or flags.ics):
+        flags.google_calendar = True
+
+    start = arrow.get('2017-01-02', 'YYYY-MM-DD')
+    dates = [start.replace(days=+n) for n in range(0, flags.days)]
+    names = ['Person {0:02d}'.format(n) for n in range(1, flags.names + 1)]
+
+    sheets_backend = Backend(flags.latency, flags.quota_error_rate, flags.seed)
+    calendar_backend = Backend(flags.latency, flags.quota_error_rate, flags.seed + 1)
+    exchange_backend = Backend(flags.latency, flags.quota_error_rate, flags.seed + 2)
+    sheets = FakeSheetsService(sheets_backend, synthetic_schedule(names, dates, flags.seed))
+    calendar = FakeCalendarService(calendar_backend)
+    exchange = FakeExchange(exchange_backend)
+
+    if not flags.rate_limits:
+        for limiter in throttling.limiters.values():
+            limiter.rate = limiter.capacity = limiter.tokens = 1e9
+    throttling.BACKOFF_SECONDS = flags.backoff_seconds
+
+    work_dir = tempfile.mkdtemp(prefix='frontline-benchmark-')
+    try:
+        script_args = ['--date', start.format('YYYY-MM-DD'), '--look_ahead_days', str(flags.days),
+                       '--spreadsheet_id', SPREADSHEET_ID, '--exchange_username', 'benchmark',
+                       '--exchange_password', 'benchmark', '--primary_smtp_address', 'benchmark@example.com']
+        if flags.google_calendar:
+            script_args.append('--google_calendar')
+        if flags.outlook_calendar:
+            script_args.append('--outlook_calendar')
+
+        if flags.script == 'frontline_calendar':
+            roster_path = os.path.join(work_dir, 'roster.json')
+            with open(roster_path, 'w') as roster_file:
+                json.dump(dict((name, {'google_calendar_id': name.replace(' ', '.') + '@example.com',
+                                       'primary_smtp_address': name.replace(' ', '.') + '@example.com'})
+                               for name in names), roster_file)
+            script_args += ['--roster', roster_path, '--state_file', os.path.join(work_dir, 'state.sqlite')]
+            if flags.ics:
+                script_args += ['--ics_output', os.path.join(work_dir, 'ics')]
+        else:
+            script_args += ['--names'] + names[:flags.lunch_names]
+
+        runs = []
+        for run in range(0, flags.runs):
+            run_args = script_args
+            if flags.metrics:
+                metrics.recorder.reset()
+                run_args = script_args + ['--metrics', '{0}.{1}'.format(flags.metrics, run + 1)]
+            before = sheets_backend.calls + calendar_backend.calls + exchange_backend.calls
+            elapsed = run_script(flags, run_args, sheets, calendar, exchange, work_dir)
+            calls = sheets_backend.calls + calendar_backend.calls + exchange_backend.calls
+            calls.subtract(before)
+            runs.append({
+                'run': run + 1,
+                'wall_seconds': round(elapsed, 3),
+                'api_calls': dict((endpoint, count) for endpoint, count in sorted(calls.items()) if count),
+                'google_events': calendar.event_count(),
+                'outlook_events': exchange.event_count(),
+            })
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {'script': flags.script, 'names': flags.names, 'days': flags.days, 'runs': runs,
+              'peak_memory_kb': peak_memory_kilobytes()}
+
+    if flags.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+        return
+
+    print("{script}: {names} names, {days} days".format(**report))
+    for run in runs:
+        print("run {run}: {wall_seconds}s, {total} API calls, {google_events} Google events, "
+              "{outlook_events} Outlook events".format(total=sum(run['api_calls'].values()), **run))
+        for endpoint, count in sorted(run['api_calls'].items()):
+            print("    {0:<36} {1}".format(endpoint, count))
+    print("peak memory: {0} KB".format(report['peak_memory_kb']))
+
+
+if __name__ == "__main__":
+    main()
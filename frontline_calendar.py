@@ -1,76 +1,383 @@
 import argparse
+import json
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import arrow
-import httplib2
-from apiclient import discovery
-from appointments import get_credentials, appointments_from_google_sheet, create_google_calendar_events, \
-    create_outlook_calendar_events, row_for_name
-from exchangelib import DELEGATE
-from exchangelib.account import Account
-from exchangelib.credentials import Credentials
+import google_services
+import throttling
+from appointments import get_credentials, appointments_from_time_blocks, rows_for_names, time_blocks_for_row, \
+    SheetSnapshot, appointment_summary, SUMMARIES, SCOPES, WATCH_SCOPES
+from googleapiclient.errors import HttpError
+from metrics import recorder, date_label
 from oauth2client import tools
+from state import StateStore, STATE_FILE, cells_hash
+
+# Days of schedule read and written per pipeline step
+PIPELINE_CHUNK_DAYS = 7
+# How often --watch asks Drive whether the spreadsheet has changed
+WATCH_INTERVAL_SECONDS = 120
+
+
+def load_roster(roster_path):
+    """
+    Reads a JSON roster of {name: {"google_calendar_id": ..., "primary_smtp_address": ..., "aliases": [...]}}. The
+    Google calendar has to be shared with the authorized Google user and the Exchange mailbox has to grant delegate
+    access to the Exchange user. The optional aliases are other ways the name is written on the schedule.
+    """
+    with open(roster_path) as roster_file:
+        return json.load(roster_file)
+
+
+def day_appointments_for_roster(snapshot, roster, dates):
+    """
+    Reads every roster member's row on each date. Returns {name: {date: (cells_hash, appointments)}} with dates as
+    YYYY-MM-DD strings. Dates whose tab could not be read are left out, so nothing recorded for them is touched.
+    """
+    days = dict((name, {}) for name in roster)
+    aliases = dict((name, person.get('aliases', [])) for name, person in roster.items())
+    for date in dates:
+        if snapshot.cells(date) is None:
+            continue
+
+        with recorder.phase('parse', date_label([date])):
+            rows = rows_for_names(snapshot, roster, date, aliases)
+            midnight = arrow.Arrow(date.year, date.month, date.day, tzinfo='America/Chicago')
+
+            for name in roster:
+                if name in rows:
+                    time_blocks = time_blocks_for_row(snapshot, rows[name], midnight)
+                    # only the appointment types that go on calendars are turned into datetimes
+                    day_appointments = appointments_from_time_blocks(time_blocks, midnight, SUMMARIES)
+                else:
+                    print("Could not find row for {name} on {date}, will clear their events for that day".format(
+                        name=name, date=date))
+                    time_blocks = []
+                    day_appointments = []
+
+                if not any(appointment_summary(appointment) for appointment in day_appointments):
+                    print("No shifts found for {name} on {date}".format(name=name, date=date))
+                days[name][date.format('YYYY-MM-DD')] = (cells_hash(time_blocks), day_appointments)
+
+    return days
+
+
+def prefetch(snapshot, dates):
+    with recorder.phase('prefetch', date_label(dates)):
+        snapshot.prefetch(dates)
+
+
+def changed_days(state, name, backend, days, full_sync):
+    return dict((date, day) for date, day in days.items()
+                if full_sync or state.cells_hash(name, date, backend) != day[0])
+
+
+def record_synced_days(state, name, backend, days, recorded, synced, failed):
+    """
+    Records each day whose appointments all made it onto the calendar and whose old events were all moved or deleted.
+    Days with any failure are left as they were so the next run tries them again.
+    """
+    for date in days:
+        day_hash, appointments = days[date]
+        complete = all(appointment in synced for appointment in appointments if appointment_summary(appointment)) and \
+            not any(event in failed for event in recorded[date])
+        if complete:
+            state.record_day(name, date, backend, day_hash,
+                             [synced[appointment] for appointment in appointments if appointment in synced])
+        else:
+            print("Could not sync every event for {name} on {date}, will try again next run".format(name=name,
+                                                                                                  date=date))
+
+
+def sync_google_calendar(name, person, days, google_calendar_service, state, label):
+    if not person.get('google_calendar_id'):
+        print("No google_calendar_id for {name}, will not sync their Google calendar".format(name=name))
+        return
+
+    from google_calendar import sync_google_calendar_events
+
+    with recorder.phase('google_calendar', label):
+        recorded = dict((date, state.events(name, date, 'google')) for date in days)
+        # days never synced before may already have events made by an older version or before the state file was lost
+        unrecorded_dates = [date for date in days if state.cells_hash(name, date, 'google') is None]
+        appointments = [appointment for date in sorted(days) for appointment in days[date][1]]
+        try:
+            synced, failed = sync_google_calendar_events(appointments,
+                                                         [event for date in recorded for event in recorded[date]],
+                                                         google_calendar_service,
+                                                         person['google_calendar_id'], name, unrecorded_dates)
+        except Exception as error:
+            # such as a calendar that isn't shared, which shouldn't stop everyone else's calendars from syncing
+            print("Could not sync the Google calendar of {name}, will try again next run: {error}".format(
+                name=name, error=error))
+            return
+        record_synced_days(state, name, 'google', days, recorded, synced, failed)
+    print("Synced {count} changed days to the Google calendar of {name}".format(count=len(days), name=name))
+
+
+def sync_outlook_calendar(name, person, days, exchange_accounts, state, label):
+    if not person.get('primary_smtp_address'):
+        print("No primary_smtp_address for {name}, will not sync their Outlook calendar".format(name=name))
+        return
+
+    from outlook_calendar import sync_outlook_calendar_events
+
+    with recorder.phase('outlook_calendar', label):
+        recorded = dict((date, state.events(name, date, 'outlook')) for date in days)
+        appointments = [appointment for date in sorted(days) for appointment in days[date][1]]
+        try:
+            synced, failed = sync_outlook_calendar_events(appointments,
+                                                          [event for date in recorded for event in recorded[date]],
+                                                          exchange_accounts.account(person['primary_smtp_address']))
+        except Exception as error:
+            # such as a mailbox autodiscover can't find, which shouldn't stop everyone else's calendars from syncing
+            print("Could not sync the Outlook calendar of {name}, will try again next run: {error}".format(
+                name=name, error=error))
+            return
+        record_synced_days(state, name, 'outlook', days, recorded, synced, failed)
+    print("Synced {count} changed days to the Outlook calendar of {name}".format(count=len(days), name=name))
+
+
+def write_ics_calendar(name, days, ics_output, state, label):
+    from ics_calendar import write_ics_days
+
+    with recorder.phase('ics_calendar', label):
+        written = write_ics_days(name, dict((date, day[1]) for date, day in days.items()), ics_output)
+        for date in days:
+            state.record_day(name, date, 'ics', days[date][0], written[date])
+
+
+def sync_window(snapshot, roster, dates, state, google_calendar_service, exchange_accounts, ics_output, reader,
+                writer, full_sync):
+    """
+    Syncs the days in dates whose cells changed since they were last synced to every roster member's calendars and,
+    if ics_output is set, to their .ics files in that directory.
+
+    The window is parsed and written in chunks of PIPELINE_CHUNK_DAYS days, and its day tabs are read in blocks of
+    the snapshot's PREFETCH_DAYS, so a spreadsheet window takes as few batchGets as possible. While a block's chunks
+    are parsed and their calendar writes run on the writer pool, the reader prefetches the next block. Google and
+    Outlook writes for a person run in parallel. Each .ics file is put back together once at the end from the days
+    that were rewritten.
+    """
+    prefetch_days = snapshot.PREFETCH_DAYS
+    blocks = [dates[i:i + prefetch_days] for i in range(0, len(dates), prefetch_days)]
+    fetches = {}
+
+    def fetch(block):
+        if block < len(blocks) and block not in fetches:
+            fetches[block] = reader.submit(prefetch, snapshot, blocks[block])
+
+    writes = []
+    ics_names = set()
+    fetch(0)
+    for start in range(0, len(dates), PIPELINE_CHUNK_DAYS):
+        chunk = dates[start:start + PIPELINE_CHUNK_DAYS]
+        last_block = (start + len(chunk) - 1) // prefetch_days
+        for block in range(start // prefetch_days, last_block + 1):
+            fetch(block)
+            fetches[block].result()
+        fetch(last_block + 1)
+
+        days = day_appointments_for_roster(snapshot, roster, chunk)
+        label = date_label(chunk)
+        for name in roster:
+            # only days whose cells changed since they were last synced to a calendar are written
+            if google_calendar_service:
+                google_days = changed_days(state, name, 'google', days[name], full_sync)
+                if google_days:
+                    writes.append(writer.submit(sync_google_calendar, name, roster[name], google_days,
+                                                google_calendar_service, state, label))
+            if exchange_accounts:
+                outlook_days = changed_days(state, name, 'outlook', days[name], full_sync)
+                if outlook_days:
+                    writes.append(writer.submit(sync_outlook_calendar, name, roster[name], outlook_days,
+                                                exchange_accounts, state, label))
+            if ics_output:
+                ics_days = changed_days(state, name, 'ics', days[name], full_sync)
+                if ics_days:
+                    ics_names.add(name)
+                    writes.append(writer.submit(write_ics_calendar, name, ics_days, ics_output, state, label))
+
+    for write in writes:
+        write.result()
+
+    if ics_names:
+        from ics_calendar import assemble_ics_calendar
+
+        with recorder.phase('ics_calendar', date_label(dates)):
+            for name in ics_names:
+                assemble_ics_calendar(name, ics_output)
+        print("Wrote the .ics files of {0}".format(', '.join(sorted(ics_names))))
+
+
+def look_ahead_dates(flags):
+    # without --date the window starts today, so a long running --watch moves along with the calendar
+    if flags.date:
+        start = arrow.get(flags.date, 'YYYY-MM-DD')
+    else:
+        start = arrow.get(arrow.now('America/Chicago').date())
+    return [start.replace(days=+n) for n in range(0, int(flags.look_ahead_days))]
+
+
+def spreadsheet_modified_time(drive_service, spreadsheet_id):
+    """
+    Asks Drive when the spreadsheet was last modified, which is far cheaper than reading its tabs. Returns None if
+    Drive could not be reached.
+    """
+    try:
+        result = throttling.execute(drive_service.files().get(fileId=spreadsheet_id, fields='modifiedTime'), 'drive')
+    except HttpError as error:
+        print("Could not check spreadsheet {id} for changes: {error}".format(id=spreadsheet_id, error=error))
+        return None
+    return result.get('modifiedTime')
+
+
+def watch(flags, modified_time_of_schedule, open_snapshot, roster, state, google_calendar_service, exchange_accounts,
+          reader, writer):
+    """
+    Polls the schedule's modified time every flags.watch_interval seconds and syncs whenever it or the look-ahead
+    window changes. open_snapshot opens the schedule afresh for every sync, and the state store keeps writes to the
+    days whose cells changed. Credentials, services, connections and Exchange accounts are all kept between syncs.
+    """
+    synced_modified_time = None
+    synced_dates = None
+    full_sync = flags.full_sync
+    try:
+        while True:
+            modified_time = modified_time_of_schedule()
+            dates = look_ahead_dates(flags)
+            if modified_time is not None and (modified_time != synced_modified_time or dates != synced_dates):
+                print("Schedule last modified at {0}, syncing changed days".format(modified_time))
+                try:
+                    snapshot = open_snapshot()
+                    try:
+                        sync_window(snapshot, roster, dates, state, google_calendar_service, exchange_accounts,
+                                    flags.ics_output, reader, writer, full_sync)
+                    finally:
+                        snapshot.close()
+                except Exception as error:
+                    # keep watching, the next poll will try this sync again
+                    print("Could not sync, will try again in {interval} seconds: {error}".format(
+                        interval=flags.watch_interval, error=error))
+                else:
+                    synced_modified_time = modified_time
+                    synced_dates = dates
+                    full_sync = False
+
+                if flags.metrics:
+                    recorder.write(flags.metrics)
+
+            time.sleep(flags.watch_interval)
+    except KeyboardInterrupt:
+        print("Stopped watching the schedule")
 
 
 def main():
     parser = argparse.ArgumentParser(parents=[tools.argparser])
-    parser.add_argument('--date', help='What date to start looking at the calendar? Use format YYYY-MM-DD.')
+    parser.add_argument('--date', help='What date to start looking at the calendar? Use format YYYY-MM-DD. Defaults '
+                                       'to today.')
     parser.add_argument('--look_ahead_days', help='How many days to look ahead from the starting date?')
     parser.add_argument('--name', help='Which person are you?')
+    parser.add_argument('--aliases', nargs='+', default=[],
+                        help='Other ways --name is written on the schedule, such as a nickname')
+    parser.add_argument('--roster', help='Path to a JSON file mapping every name on the schedule to their calendars. '
+                                         'Syncs everyone on it instead of a single --name.')
+    parser.add_argument('--workers', type=int, default=4, help='How many calendar writes to run at once?')
+    parser.add_argument('--state_file', default=STATE_FILE,
+                        help='Where to keep the record of what has been synced, so unchanged days can be skipped')
+    parser.add_argument('--full_sync', action='store_true',
+                        help='Diff every day against the events recorded in --state_file, even days whose cells have '
+                             'not changed. Events changed or deleted by hand on a calendar are not noticed, delete '
+                             '--state_file to have them checked against the calendars again.')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and sync again whenever the spreadsheet changes')
+    parser.add_argument('--watch_interval', type=float, default=WATCH_INTERVAL_SECONDS,
+                        help='How many seconds --watch waits between checks for changes')
     parser.add_argument('--google_calendar', action='store_true')
     parser.add_argument('--outlook_calendar', action='store_true')
+    parser.add_argument('--ics_output', help='Directory to write an .ics file for each person to, which calendar apps '
+                                             'can subscribe to instead of having events written to them')
     parser.add_argument('--spreadsheet_id', help='The ID of the ECBU Luminate Support Weekly Schedule spreadsheet',
                         default='1RgDgDRcyAFDdkEyRH7m_4QOtJ7e-kv324hEWE4JuwgI')
+    parser.add_argument('--schedule_file', help='Read the schedule from an exported .xlsx workbook, or a directory of '
+                                                'per-day CSV files named after their tabs, instead of the spreadsheet')
     parser.add_argument('--exchange_username',
                         help='The username you use in Outlook, should be Firstname.Lastname@Blackbaud.me')
     parser.add_argument('--primary_smtp_address',
                         help='Your Outlook email address, should be Firstname.Lastname@blackbaud.com')
     parser.add_argument('--exchange_password', help='The password you use in Outlook')
+    parser.add_argument('--metrics', help='Write API call and phase timing metrics as JSON to this file, or - for '
+                                          'standard output')
 
     flags = parser.parse_args()
 
     print("Running with args: " + str(sys.argv))
 
-    if not flags.google_calendar or flags.outlook_calendar:
-        print("You need to specify --google_calendar and/or --outlook_calendar")
+    if not (flags.google_calendar or flags.outlook_calendar or flags.ics_output):
+        print("You need to specify --google_calendar, --outlook_calendar and/or --ics_output")
         return
 
-    today = arrow.get(flags.date, 'YYYY-MM-DD')
-    dates = [today.replace(days=+n) for n in range(0, int(flags.look_ahead_days))]
+    if flags.roster:
+        roster = load_roster(flags.roster)
+    else:
+        roster = {flags.name: {'google_calendar_id': 'primary', 'primary_smtp_address': flags.primary_smtp_address,
+                               'aliases': flags.aliases}}
+
+    http = None
+    # a local schedule that is only written to Outlook or .ics files needs no Google credentials at all
+    if flags.google_calendar or not flags.schedule_file:
+        # the Drive scope is only asked for when it is needed, so scheduled runs never stop to authorize again
+        credentials = get_credentials(flags, WATCH_SCOPES if flags.watch and not flags.schedule_file else SCOPES)
+        # every service shares one pool of authorized connections, which is safe to use from any thread
+        http = google_services.HttpPool(credentials)
+
+    if flags.schedule_file:
+        from schedule_sources import open_schedule, schedule_modified_time
 
-    credentials = get_credentials(flags)
+        def open_snapshot():
+            return open_schedule(flags.schedule_file)
 
-    http = credentials.authorize(httplib2.Http())
-    sheets_service = discovery.build('sheets', 'v4', http=http)
+        def modified_time_of_schedule():
+            return schedule_modified_time(flags.schedule_file)
+    else:
+        sheets_service = google_services.build('sheets', 'v4', http=http)
+        drive_service = google_services.build('drive', 'v3', http=http) if flags.watch else None
+
+        def open_snapshot():
+            return SheetSnapshot(sheets_service, flags.spreadsheet_id)
+
+        def modified_time_of_schedule():
+            return spreadsheet_modified_time(drive_service, flags.spreadsheet_id)
+
+    state = StateStore(flags.state_file)
 
     google_calendar_service = None
     if flags.google_calendar:
-        google_calendar_service = discovery.build('calendar', 'v3', http=http)
+        google_calendar_service = google_services.build('calendar', 'v3', http=http)
 
-    exchange_account = None
+    exchange_accounts = None
     if flags.outlook_calendar:
-        exchange_credentials = Credentials(username=flags.exchange_username, password=flags.exchange_password)
-        exchange_account = Account(primary_smtp_address=flags.primary_smtp_address, credentials=exchange_credentials,
-                                   autodiscover=True, access_type=DELEGATE)
-
-    for date in dates:
-        row = row_for_name(sheets_service, flags.spreadsheet_id, flags.name, date)
-        if not row:
-            print("Could not find row for {name} on {date}, will skip to next day".format(name=flags.name, date=date))
-            continue
+        # exchangelib is slow to import, so it is only loaded when Outlook calendars are synced
+        from outlook_calendar import ExchangeAccounts
+        exchange_accounts = ExchangeAccounts(flags.exchange_username, flags.exchange_password)
 
-        midnight = arrow.Arrow(date.year, date.month, date.day, tzinfo='America/Chicago')
-        appointments = appointments_from_google_sheet(sheets_service, flags.spreadsheet_id, row, midnight)
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=flags.workers) as writer:
+        if flags.watch:
+            watch(flags, modified_time_of_schedule, open_snapshot, roster, state, google_calendar_service,
+                  exchange_accounts, reader, writer)
+        else:
+            snapshot = open_snapshot()
+            try:
+                sync_window(snapshot, roster, look_ahead_dates(flags), state, google_calendar_service,
+                            exchange_accounts, flags.ics_output, reader, writer, flags.full_sync)
+            finally:
+                snapshot.close()
 
-        if google_calendar_service:
-            events_made = create_google_calendar_events(appointments, google_calendar_service)
-            if events_made == 0:
-                print("No shifts found for {0}".format(date))
+    state.close()
 
-        if exchange_account:
-            events_made = create_outlook_calendar_events(appointments, exchange_account)
-            if events_made == 0:
-                print("No shifts found for {0}".format(date))
+    if flags.metrics:
+        recorder.write(flags.metrics)
 
 if __name__ == "__main__":
     main()
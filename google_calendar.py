@@ -0,0 +1,233 @@
+import metrics
+import throttling
+from appointments import appointment_event_id, calendar_event_key, diff_synced_events, synced_event, \
+    EVENT_DESCRIPTION, REMINDER_MINUTES
+from googleapiclient.errors import HttpError
+
+# Google Calendar accepts at most 50 calls per batch request and 2500 events per list page
+GOOGLE_BATCH_MAX_REQUESTS = 50
+GOOGLE_LIST_MAX_RESULTS = 2500
+
+
+def create_google_calendar_events(appointments, google_calendar_service, calendar_id='primary', person=None):
+    synced, failed = sync_google_calendar_events(appointments, [], google_calendar_service, calendar_id, person)
+    return len(synced)
+
+
+def sync_google_calendar_events(appointments, recorded_events, google_calendar_service, calendar_id='primary',
+                                person=None, unrecorded_dates=None):
+    """
+    Makes a Google Calendar match the appointments, given the events previously recorded as made for them. Recorded
+    events that no longer match an appointment are deleted.
+
+    New appointments on unrecorded_dates, YYYY-MM-DD dates nothing has been recorded for, or on any date if it is
+    None, may already be on the calendar with an ID of their own, so the calendar is listed once for their span and
+    matching events are adopted. The rest are inserted with the deterministic ID of the person's appointment, person
+    defaulting to calendar_id. An insert whose ID the calendar already has, such as an event deleted since, fails with
+    409 Conflict, and that event is updated instead if it has the appointment's summary; one with another summary
+    belongs to someone else and is left alone. Every write goes through HTTP batch requests.
+
+    Returns the {appointment: SyncedEvent} of every appointment now on the calendar and the recorded events that could
+    not be moved or deleted.
+    """
+    synced, moves, new, stale = diff_synced_events(appointments, recorded_events)
+    # an event's ID can't change, so a moved appointment gets a new event rather than an old one whose ID belongs to
+    # another appointment
+    stale += [event for event, appointment, summary in moves]
+    new += [(appointment, summary) for event, appointment, summary in moves]
+    failed = []
+    conflicts = []
+    operations = []
+
+    unrecorded = [(appointment, summary) for appointment, summary in new
+                  if unrecorded_dates is None or appointment.start_time.format('YYYY-MM-DD') in unrecorded_dates]
+    if unrecorded:
+        time_min = min(appointment.start_time for appointment, summary in unrecorded)
+        time_max = max(appointment.end_time for appointment, summary in unrecorded)
+        existing_events = google_calendar_events_index(google_calendar_service, calendar_id, time_min, time_max)
+
+        for appointment, summary in unrecorded:
+            key = calendar_event_key(summary, appointment.start_time, appointment.end_time)
+            if key in existing_events:
+                print("Found matching Google Calendar event for appointment {app}. Will not create a new one.".format(
+                    app=appointment))
+                synced[appointment] = synced_event(existing_events.pop(key), None, summary, appointment)
+
+    for appointment, summary in new:
+        if appointment in synced:
+            continue
+        event_id = appointment_event_id(person or calendar_id, appointment)
+        operations.append(google_insert_operation(google_calendar_service, calendar_id, event_id, appointment, summary,
+                                                  synced, conflicts))
+
+    for event in stale:
+        operations.append(google_delete_operation(google_calendar_service, calendar_id, event, failed))
+
+    execute_google_calendar_batches(google_calendar_service, operations)
+
+    # only appointments whose ID is already taken by an event that doesn't match them cost more calls
+    updates = []
+    execute_google_calendar_batches(google_calendar_service, [
+        google_get_operation(google_calendar_service, calendar_id, event_id, appointment, summary, updates)
+        for event_id, appointment, summary in conflicts])
+    execute_google_calendar_batches(google_calendar_service, [
+        google_update_operation(google_calendar_service, calendar_id, event_id, appointment, summary, synced)
+        for event_id, appointment, summary in updates])
+
+    return synced, failed
+
+
+def google_calendar_events_index(calendar_service, calendar_id, time_min, time_max):
+    """
+    Lists every event between time_min and time_max, following pages, and returns {calendar_event_key: event ID}.
+    """
+    index = {}
+    request = calendar_service.events().list(calendarId=calendar_id, timeMin=time_min.datetime.isoformat(),
+                                             timeMax=time_max.datetime.isoformat(), singleEvents=True,
+                                             maxResults=GOOGLE_LIST_MAX_RESULTS)
+    while request is not None:
+        response = throttling.execute(request, 'calendar')
+        for event in response.get('items', []):
+            # all day events only have a 'date' and can never match a shift
+            if 'dateTime' in event.get('start', {}) and 'dateTime' in event.get('end', {}):
+                index[calendar_event_key(event.get('summary'), event['start']['dateTime'],
+                                         event['end']['dateTime'])] = event['id']
+        request = calendar_service.events().list_next(request, response)
+
+    return index
+
+
+def google_calendar_event_times(appointment):
+    return {
+        'start': {
+            'dateTime': appointment.start_time.datetime.isoformat()
+        },
+        'end': {
+            'dateTime': appointment.end_time.datetime.isoformat()
+        }
+    }
+
+
+def google_calendar_event_body(appointment, summary):
+    event = {
+        'summary': summary,
+        'reminders': {
+            'useDefault': False,
+            'overrides': [
+                {
+                    'method': 'popup',
+                    'minutes': str(minutes)
+                } for minutes in REMINDER_MINUTES
+            ]
+        },
+        'description': EVENT_DESCRIPTION
+    }
+    event.update(google_calendar_event_times(appointment))
+    return event
+
+
+def google_insert_operation(calendar_service, calendar_id, event_id, appointment, summary, synced, conflicts):
+    def request():
+        return calendar_service.events().insert(calendarId=calendar_id,
+                                                body=dict(google_calendar_event_body(appointment, summary),
+                                                          id=event_id))
+
+    def done(event, exception):
+        if isinstance(exception, HttpError) and exception.resp.status == 409:
+            conflicts.append((event_id, appointment, summary))
+            return
+        if exception is not None:
+            print("Could not create Google Calendar event for appointment {app}: {error}".format(app=appointment,
+                                                                                                 error=exception))
+            return
+        print('Google Calendar event created. Link: {0} Details: {1}'.format(event.get('htmlLink'), event))
+        synced[appointment] = synced_event(event['id'], None, summary, appointment)
+
+    return request, done
+
+
+def google_get_operation(calendar_service, calendar_id, event_id, appointment, summary, updates):
+    def request():
+        return calendar_service.events().get(calendarId=calendar_id, eventId=event_id)
+
+    def done(event, exception):
+        if exception is not None:
+            print("Could not get Google Calendar event {id} for appointment {app}: {error}".format(
+                id=event_id, app=appointment, error=exception))
+            return
+        # the ID only hashes the person and times, so never take over an event made for something else
+        if event.get('summary') != summary:
+            print("Google Calendar event {id} for appointment {app} is {summary!r}, not {expected!r}. Will not update "
+                  "it.".format(id=event_id, app=appointment, summary=event.get('summary'), expected=summary))
+            return
+        updates.append((event_id, appointment, summary))
+
+    return request, done
+
+
+def google_update_operation(calendar_service, calendar_id, event_id, appointment, summary, synced):
+    def request():
+        # a deleted event keeps its ID, so it is brought back rather than left cancelled
+        return calendar_service.events().update(calendarId=calendar_id, eventId=event_id,
+                                                body=dict(google_calendar_event_body(appointment, summary),
+                                                          status='confirmed'))
+
+    def done(event, exception):
+        if exception is not None:
+            print("Could not update Google Calendar event for appointment {app}: {error}".format(app=appointment,
+                                                                                                 error=exception))
+            return
+        print('Found Google Calendar event {id} for appointment {app}, updated it'.format(id=event_id,
+                                                                                          app=appointment))
+        synced[appointment] = synced_event(event_id, None, summary, appointment)
+
+    return request, done
+
+
+def google_delete_operation(calendar_service, calendar_id, event, failed):
+    def request():
+        return calendar_service.events().delete(calendarId=calendar_id, eventId=event.event_id)
+
+    def done(response, exception):
+        # an event that is already gone was most likely deleted by hand, which is what we wanted anyway
+        if exception is not None and not (isinstance(exception, HttpError) and exception.resp.status in (404, 410)):
+            print("Could not delete Google Calendar event {event}: {error}".format(event=event, error=exception))
+            failed.append(event)
+            return
+        print('Google Calendar event deleted. Details: {0}'.format(event))
+
+    return request, done
+
+
+def execute_google_calendar_batches(calendar_service, operations):
+    """
+    Runs (request, done) operations through HTTP batch requests. request builds the API call and done is called with
+    its response and exception once any throttled calls have been resent in a smaller batch after backing off.
+    """
+    for i in range(0, len(operations), GOOGLE_BATCH_MAX_REQUESTS):
+        pending = operations[i:i + GOOGLE_BATCH_MAX_REQUESTS]
+        attempt = 0
+        while pending:
+            throttled = []
+
+            requests = [request() for request, done in pending]
+
+            def callback(request_id, response, exception):
+                operation = pending[int(request_id)]
+                if exception is not None and attempt < throttling.MAX_RETRIES and throttling.is_retryable(exception):
+                    throttled.append(operation)
+                    return
+                metrics.recorder.record_call(getattr(requests[int(request_id)], 'methodId', 'calendar'), [], 1,
+                                             attempt, 0.0, 'ok' if exception is None else type(exception).__name__)
+                operation[1](response, exception)
+
+            batch = calendar_service.new_batch_http_request(callback=callback)
+            for j in range(0, len(requests)):
+                batch.add(requests[j], request_id=str(j))
+            # every call in a batch counts against the Calendar quota on its own
+            throttling.call('calendar', batch.execute, tokens=len(pending), endpoint='calendar.batch')
+
+            if throttled:
+                throttling.backoff(attempt)
+                attempt += 1
+            pending = throttled
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+import httplib2
+from googleapiclient import discovery
+
+DISCOVERY_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.frontline_calendar', 'discovery')
+# Discovery documents only change when Google changes an API, a day old copy is fine
+DISCOVERY_CACHE_TTL = 24 * 60 * 60
+
+
+class DiscoveryCache:
+    """
+    googleapiclient discovery document cache that keeps each document in a file under directory for ttl seconds, so
+    building a service doesn't fetch its discovery document over the network on every run. Documents already read
+    are kept in memory too, since every worker thread builds its own Calendar service.
+    """
+
+    def __init__(self, directory=DISCOVERY_CACHE_DIR, ttl=DISCOVERY_CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, url):
+        with self.lock:
+            if url in self.documents:
+                return self.documents[url]
+
+            path = self._path(url)
+            try:
+                if time.time() - os.path.getmtime(path) > self.ttl:
+                    return None
+                with open(path, 'rb') as document_file:
+                    content = document_file.read().decode('utf-8')
+            except (IOError, OSError):
+                return None
+
+            self.documents[url] = content
+            return content
+
+    def set(self, url, content):
+        with self.lock:
+            self.documents[url] = content
+            try:
+                if not os.path.exists(self.directory):
+                    os.makedirs(self.directory)
+                # write to a temporary file first so a concurrent run never reads half a document
+                handle, temporary_path = tempfile.mkstemp(dir=self.directory)
+                with os.fdopen(handle, 'wb') as document_file:
+                    document_file.write(content.encode('utf-8'))
+                os.replace(temporary_path, self._path(url))
+            except (IOError, OSError) as error:
+                print("Could not cache discovery document for {url}: {error}".format(url=url, error=error))
+
+
+discovery_cache = DiscoveryCache()
+
+
+class HttpPool:
+    """
+    Stands in for an authorized httplib2.Http that any number of threads can share, so one built service can serve
+    every worker thread. Each request borrows an idle authorized Http, or authorizes a new one when they are all busy,
+    and returns it afterwards. httplib2 keeps each Http's connections open, so later requests skip the TCP and TLS
+    handshakes.
+    """
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.idle = []
+        self.lock = threading.Lock()
+
+        def request(*args, **kwargs):
+            http = self._borrow()
+            try:
+                return http.request(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.idle.append(http)
+
+        # googleapiclient batch requests look for the credentials on request, where credentials.authorize puts them
+        request.credentials = credentials
+        self.request = request
+
+    def _borrow(self):
+        with self.lock:
+            if self.idle:
+                # the most recently used Http is the one whose connections are most likely still open
+                return self.idle.pop()
+        return self.credentials.authorize(httplib2.Http())
+
+
+def build(service_name, version, http):
+    """
+    Builds a googleapiclient service from the cached discovery document when there is a fresh one. Pass an HttpPool
+    as http to share the service between threads.
+    """
+    return discovery.build(service_name, version, http=http, cache_discovery=True, cache=discovery_cache)
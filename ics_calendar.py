@@ -0,0 +1,131 @@
+import os
+import re
+import shutil
+import tempfile
+
+import arrow
+from appointments import appointment_event_id, appointment_summary, synced_event, EVENT_DESCRIPTION, REMINDER_MINUTES
+
+# Every person gets <ics_output>/<name>.ics to subscribe to. The events of each day are rendered into their own
+# fragment under <ics_output>/.days/<name>/, so a changed day only re-renders that day and the feed is put back
+# together by copying the fragments into it.
+DAYS_DIR = '.days'
+PRODID = '-//Frontline Calendar//Frontline Calendar//EN'
+# RFC 5545 lines are folded at 75 octets
+MAX_LINE_OCTETS = 75
+
+
+def ics_file_name(name):
+    return re.sub(r'[^\w.-]+', '_', name).strip('_') + '.ics'
+
+
+def ics_days_dir(name, directory):
+    return os.path.join(directory, DAYS_DIR, ics_file_name(name)[:-len('.ics')])
+
+
+def ics_text(value):
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def ics_time(time):
+    return arrow.get(time).to('UTC').format('YYYYMMDDTHHmmss') + 'Z'
+
+
+def ics_line(line):
+    """
+    Folds a content line into CRLF terminated lines of at most MAX_LINE_OCTETS octets, continued with a leading space.
+    """
+    encoded = line.encode('utf-8')
+    folded = []
+    limit = MAX_LINE_OCTETS
+    while len(encoded) > limit:
+        cut = limit
+        # don't split a multi-byte character
+        while cut > 0 and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        folded.append(encoded[:cut])
+        encoded = encoded[cut:]
+        limit = MAX_LINE_OCTETS - 1
+    folded.append(encoded)
+    return b'\r\n '.join(folded) + b'\r\n'
+
+
+def ics_uid(name, appointment):
+    return appointment_event_id(name, appointment) + '@frontline-calendar'
+
+
+def ics_event(uid, summary, appointment, stamp):
+    lines = [
+        'BEGIN:VEVENT',
+        'UID:' + uid,
+        'DTSTAMP:' + stamp,
+        'DTSTART:' + ics_time(appointment.start_time),
+        'DTEND:' + ics_time(appointment.end_time),
+        'SUMMARY:' + ics_text(summary),
+        'DESCRIPTION:' + ics_text(EVENT_DESCRIPTION),
+    ]
+    for minutes in REMINDER_MINUTES:
+        lines += [
+            'BEGIN:VALARM',
+            'ACTION:DISPLAY',
+            'DESCRIPTION:' + ics_text(summary),
+            'TRIGGER:-PT{0}M'.format(minutes),
+            'END:VALARM',
+        ]
+    lines.append('END:VEVENT')
+    return b''.join(ics_line(line) for line in lines)
+
+
+def write_ics_days(name, days, directory):
+    """
+    Renders the events of each of the person's days, given as {date: appointments}, into that day's fragment. Days
+    without events have their fragment removed. Returns {date: [SyncedEvent]} of the events written for each day.
+    """
+    days_dir = ics_days_dir(name, directory)
+    if not os.path.exists(days_dir):
+        os.makedirs(days_dir)
+
+    stamp = ics_time(arrow.utcnow())
+    written = {}
+    for date, appointments in days.items():
+        events = []
+        content = []
+        for appointment in appointments:
+            summary = appointment_summary(appointment)
+            if not summary:
+                continue
+            uid = ics_uid(name, appointment)
+            content.append(ics_event(uid, summary, appointment, stamp))
+            events.append(synced_event(uid, None, summary, appointment))
+
+        path = os.path.join(days_dir, date + '.ics')
+        if content:
+            with open(path, 'wb') as fragment:
+                fragment.write(b''.join(content))
+        elif os.path.exists(path):
+            os.remove(path)
+        written[date] = events
+
+    return written
+
+
+def assemble_ics_calendar(name, directory):
+    """
+    Writes the person's feed from their day fragments in date order, streaming each fragment into a temporary file
+    that then replaces the feed, so subscribers never see half a calendar.
+    """
+    days_dir = ics_days_dir(name, directory)
+    fragments = sorted(os.listdir(days_dir)) if os.path.isdir(days_dir) else []
+
+    handle, temporary_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, 'wb') as feed:
+        for line in ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:' + PRODID, 'CALSCALE:GREGORIAN',
+                     'X-WR-CALNAME:' + ics_text('Frontline Calendar for ' + name)]:
+            feed.write(ics_line(line))
+        for fragment_name in fragments:
+            with open(os.path.join(days_dir, fragment_name), 'rb') as fragment:
+                shutil.copyfileobj(fragment, feed)
+        feed.write(ics_line('END:VCALENDAR'))
+    # mkstemp only lets the owner read the file, and feeds are usually served by another user
+    os.chmod(temporary_path, 0o644)
+    os.replace(temporary_path, os.path.join(directory, ics_file_name(name)))
@@ -1,27 +1,21 @@
 import argparse
 import sys
-from math import floor
 
 import arrow
-import httplib2
-from apiclient import discovery
-from appointments import get_credentials, appointments_from_google_sheet, create_google_calendar_events, \
-    create_outlook_calendar_events, Range, Appointment, LUNCH, row_for_name
-from exchangelib import DELEGATE
-from exchangelib.account import Account
-from exchangelib.credentials import Credentials
+import google_services
+from appointments import get_credentials, time_from_cell_index, Appointment, LUNCH, SheetSnapshot
+from availability import common_free_runs, BLOCKING_TYPES, LUNCH_EARLIEST, LUNCH_LATEST, LUNCH_MIN_HOURS
+from metrics import recorder, date_label
 from oauth2client import tools
 
-LUNCH_EARLIEST = 11.0
-LUNCH_LATEST = 16.0
 
-
-def fractional_hour(datetime):
-    return datetime.hour + (float(datetime.minute) / 60)
-
-
-def hour_minute_from_fractional_hour(fractional):
-    return int(floor(fractional)), int((fractional - floor(fractional)) * 60)
+def lunch_summary(names):
+    """
+    Calendar event summary naming everyone at the lunch, such as "Abby, Ali and Sam Lunch Date".
+    """
+    if len(names) < 2:
+        return ' '.join(names) + ' Lunch Date'
+    return '{0} and {1} Lunch Date'.format(', '.join(names[:-1]), names[-1])
 
 
 def main():
@@ -30,92 +24,96 @@ def main():
     parser.add_argument('--look_ahead_days', help='How many days to look ahead from the starting date?')
     parser.add_argument('--first_name', help='Name of first person on lunch date')
     parser.add_argument('--second_name', help='Name of second person on lunch date')
+    parser.add_argument('--names', nargs='+', help='Names of everyone to find a time for, instead of --first_name '
+                                                   'and --second_name')
+    parser.add_argument('--blocking_types', nargs='+', default=BLOCKING_TYPES,
+                        help='Which schedule cell types keep someone from joining?')
+    parser.add_argument('--earliest', type=float, default=LUNCH_EARLIEST,
+                        help='Earliest hour to schedule at, such as 11.5 for 11:30')
+    parser.add_argument('--latest', type=float, default=LUNCH_LATEST, help='Hour everything has to be over by')
+    parser.add_argument('--min_hours', type=float, default=LUNCH_MIN_HOURS,
+                        help='Shortest free time worth scheduling, in hours')
+    parser.add_argument('--summary', help='Title of the calendar events, such as "Team Huddle". Defaults to a lunch '
+                                          'date naming everyone.')
     parser.add_argument('--google_calendar', action='store_true')
     parser.add_argument('--outlook_calendar', action='store_true')
     parser.add_argument('--spreadsheet_id', help='The ID of the ECBU Luminate Support Weekly Schedule spreadsheet', default='1RgDgDRcyAFDdkEyRH7m_4QOtJ7e-kv324hEWE4JuwgI')
+    parser.add_argument('--schedule_file', help='Read the schedule from an exported .xlsx workbook, or a directory of '
+                                                'per-day CSV files named after their tabs, instead of the spreadsheet')
     parser.add_argument('--exchange_username',
                         help='The username you use in Outlook, should be Firstname.Lastname@Blackbaud.me')
     parser.add_argument('--primary_smtp_address',
                         help='Your Outlook email address, should be Firstname.Lastname@blackbaud.com')
     parser.add_argument('--exchange_password', help='The password you use in Outlook')
+    parser.add_argument('--metrics', help='Write API call and phase timing metrics as JSON to this file, or - for '
+                                          'standard output')
 
     flags = parser.parse_args()
 
     print("Running with args: " + str(sys.argv))
 
-    if not flags.google_calendar or flags.outlook_calendar:
+    if not (flags.google_calendar or flags.outlook_calendar):
         print("You need to specify --google_calendar and/or --outlook_calendar")
         return
 
     today = arrow.get(flags.date, 'YYYY-MM-DD')
     dates = [today.replace(days=+n) for n in range(0, int(flags.look_ahead_days))]
 
-    credentials = get_credentials(flags)
+    http = None
+    # a local schedule that is only written to Outlook needs no Google credentials at all
+    if flags.google_calendar or not flags.schedule_file:
+        http = google_services.HttpPool(get_credentials(flags))
 
-    http = credentials.authorize(httplib2.Http())
-    sheets_service = discovery.build('sheets', 'v4', http=http)
+    if flags.schedule_file:
+        from schedule_sources import open_schedule
+        snapshot = open_schedule(flags.schedule_file)
+    else:
+        snapshot = SheetSnapshot(google_services.build('sheets', 'v4', http=http), flags.spreadsheet_id)
+    label = date_label(dates or [today])
+    with recorder.phase('prefetch', label):
+        snapshot.prefetch(dates)
 
     google_calendar_service = None
     if flags.google_calendar:
-        google_calendar_service = discovery.build('calendar', 'v3', http=http)
+        google_calendar_service = google_services.build('calendar', 'v3', http=http)
 
     exchange_account = None
     if flags.outlook_calendar:
-        exchange_credentials = Credentials(username=flags.exchange_username, password=flags.exchange_password)
-        exchange_account = Account(primary_smtp_address=flags.primary_smtp_address, credentials=exchange_credentials,
-                                   autodiscover=True, access_type=DELEGATE)
-
-    for date in dates:
+        # exchangelib is slow to import, so it is only loaded when the Outlook calendar is written
+        from outlook_calendar import ExchangeAccounts
+        exchange_account = ExchangeAccounts(flags.exchange_username,
+                                            flags.exchange_password).account(flags.primary_smtp_address)
+
+    names = flags.names or [flags.first_name, flags.second_name]
+    summary = flags.summary or lunch_summary(names)
+    weekdays = [date for date in dates if date.weekday() not in [5, 6]]  # skip weekends
+
+    all_lunch_appointments = []
+    for date, runs in common_free_runs(snapshot, names, weekdays, flags.blocking_types, flags.earliest, flags.latest,
+                                       flags.min_hours):
         midnight = arrow.Arrow(date.year, date.month, date.day, tzinfo='America/Chicago')
-
-        first_row = row_for_name(sheets_service, flags.spreadsheet_id, flags.first_name, date)
-        if not first_row:
-            print("Could not find row for {name} on {date}, will skip to next day".format(name=flags.first_name, date=date))
-            continue
-
-        second_row = row_for_name(sheets_service, flags.spreadsheet_id, flags.second_name, date)
-        if not second_row:
-            print("Could not find row for {name} on {date}, will skip to next day".format(name=flags.second_name, date=date))
-            continue
-
-        first_appointments = appointments_from_google_sheet(sheets_service, flags.spreadsheet_id, first_row, midnight)
-        second_appointments = appointments_from_google_sheet(sheets_service, flags.spreadsheet_id, second_row, midnight)
-
-        if date.weekday() in [5, 6]:  # skip weekends
-            continue
-
-        # if no appointments are found, don't try to schedule lunch
-        if not first_appointments or not second_appointments:
-            print("No schedule yet defined for {0}".format(date))
-            continue
-
-        lunch_ranges = [Range(LUNCH_EARLIEST, LUNCH_LATEST)]
-        for appointment in first_appointments + second_appointments:
-            if appointment.appointment_type in ['F', 'C', 'PTO']:
-                new_lunch_ranges = []
-                appointment_range = Range(fractional_hour(appointment.start_time), fractional_hour(appointment.end_time))
-                for lunch_range in lunch_ranges:
-                    new_lunch_ranges.extend(lunch_range.subtract(appointment_range))
-                lunch_ranges = new_lunch_ranges
-
-        # cut out ranges that are too short
-        lunch_ranges = [r for r in lunch_ranges if r.length() >= 1.5]
-
-        lunch_appointments = [Appointment(midnight.replace(hour=hour_minute_from_fractional_hour(r.start)[0],
-                                                           minute=hour_minute_from_fractional_hour(r.start)[1]),
-                                          midnight.replace(hour=hour_minute_from_fractional_hour(r.end)[0],
-                                                           minute=hour_minute_from_fractional_hour(r.end)[1]),
-                                          LUNCH) for r in lunch_ranges]
-
-        if google_calendar_service:
-            events_made = create_google_calendar_events(lunch_appointments, google_calendar_service)
-            if events_made == 0:
-                print("No shifts found for {0}".format(date))
-
-        if exchange_account:
-            events_made = create_outlook_calendar_events(lunch_appointments, exchange_account)
-            if events_made == 0:
-                print("No shifts found for {0}".format(date))
+        lunch_appointments = [Appointment(time_from_cell_index(start, midnight), time_from_cell_index(end, midnight),
+                                          LUNCH, summary) for start, end in runs]
+
+        if not lunch_appointments:
+            print("No shifts found for {0}".format(date))
+        all_lunch_appointments.extend(lunch_appointments)
+
+    # calendars are written once for the whole look-ahead window so existing events can be listed in bulk
+    if google_calendar_service:
+        from google_calendar import create_google_calendar_events
+        with recorder.phase('google_calendar', label):
+            # every group's lunches share the primary calendar, so the group and summary go into their event IDs
+            create_google_calendar_events(all_lunch_appointments, google_calendar_service,
+                                          person='{0}|{1}'.format(', '.join(sorted(names)), summary))
+
+    if exchange_account:
+        from outlook_calendar import create_outlook_calendar_events
+        with recorder.phase('outlook_calendar', label):
+            create_outlook_calendar_events(all_lunch_appointments, exchange_account)
+
+    if flags.metrics:
+        recorder.write(flags.metrics)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,120 @@
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of values, or None if there are none.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def rounded(seconds):
+    return None if seconds is None else round(seconds, 4)
+
+
+def date_label(dates):
+    """
+    Labels phase timings with the YYYY-MM-DD date of dates, or with a first/last ISO 8601 interval when they cover
+    several dates. dates may be Arrow objects or YYYY-MM-DD strings.
+    """
+    days = sorted(date if isinstance(date, str) else date.format('YYYY-MM-DD') for date in dates)
+    if days[0] == days[-1]:
+        return days[0]
+    return '{0}/{1}'.format(days[0], days[-1])
+
+
+class EndpointMetrics:
+    __slots__ = ('latencies', 'outcomes', 'retries', 'items', 'waited')
+
+    def __init__(self):
+        self.latencies = []
+        self.outcomes = defaultdict(int)
+        self.retries = 0
+        self.items = 0
+        self.waited = 0.0
+
+    def report(self):
+        return {
+            'calls': sum(self.outcomes.values()),
+            'outcomes': dict(self.outcomes),
+            'retries': self.retries,
+            'items': self.items,
+            'latency_p50': rounded(percentile(self.latencies, 0.5)),
+            'latency_p95': rounded(percentile(self.latencies, 0.95)),
+            'waited_seconds': rounded(self.waited),
+        }
+
+
+class Metrics:
+    """
+    Thread-safe record of every backend API call and of how long each phase of a run took for each date.
+
+    Calls are recorded per endpoint, which is the method ID for Google calls (such as calendar.events.insert) and the
+    service name for Exchange calls, with the latency of every attempt, how many items the call carried, how often it
+    was retried, how long it waited on rate limits and backoff, and its outcome: ok or the name of the error it raised.
+    Calls made inside a Google batch request are recorded with their outcome but without a latency of their own.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.endpoints = defaultdict(EndpointMetrics)
+            self.phases = defaultdict(lambda: defaultdict(float))
+
+    def record_call(self, endpoint, latencies, items, retries, waited, outcome):
+        with self.lock:
+            metrics = self.endpoints[endpoint]
+            metrics.latencies.extend(latencies)
+            metrics.outcomes[outcome] += 1
+            metrics.retries += retries
+            metrics.items += items
+            metrics.waited += waited
+
+    @contextmanager
+    def phase(self, name, label):
+        """
+        Times the with block and adds it to the phase's total for label. Phases that run on several threads at once,
+        such as calendar writes, add up the time spent on each thread.
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            with self.lock:
+                self.phases[label][name] += elapsed
+
+    def report(self):
+        with self.lock:
+            return {
+                'wall_seconds': round(time.time() - self.started, 3),
+                'endpoints': dict((endpoint, metrics.report()) for endpoint, metrics in self.endpoints.items()),
+                'phases': dict((label, dict((name, rounded(seconds)) for name, seconds in phases.items()))
+                               for label, phases in self.phases.items()),
+            }
+
+    def write(self, path):
+        """
+        Writes the report as JSON to path, or to standard output if path is -.
+        """
+        report = json.dumps(self.report(), indent=2, sort_keys=True)
+        if path == '-':
+            sys.stdout.write(report + '\n')
+            return
+        with open(path, 'w') as metrics_file:
+            metrics_file.write(report + '\n')
+
+
+recorder = Metrics()
@@ -0,0 +1,277 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import throttling
+from appointments import calendar_event_key, diff_synced_events, synced_event, EVENT_DESCRIPTION
+from exchangelib import DELEGATE, EWSTimeZone, EWSDateTime, IdOnly
+from exchangelib.account import Account
+from exchangelib.credentials import Credentials
+from exchangelib.errors import EWSError, ErrorItemNotFound, ErrorServerBusy, RateLimitError
+from exchangelib.folders import CalendarItem
+from exchangelib.protocol import Protocol
+from exchangelib.restriction import Restriction
+from exchangelib.services import CreateItem, FindItem
+
+# The only calendar item fields we need back from Exchange to recognise an event we already made
+OUTLOOK_COMPARED_FIELDS = ['item:Subject', 'calendar:Start', 'calendar:End']
+EXCHANGE_THROTTLING_ERRORS = (ErrorServerBusy, RateLimitError)
+
+AUTODISCOVER_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.frontline_calendar', 'autodiscover.json')
+# Mailboxes rarely move between servers, and a stale entry is noticed and discovered again anyway
+AUTODISCOVER_CACHE_TTL = 7 * 24 * 60 * 60
+
+# exchangelib 1.5's Configuration refuses a service_endpoint, and Account only ever reads a config's protocol
+DiscoveredConfiguration = namedtuple('DiscoveredConfiguration', ['protocol'])
+
+# exchangelib 1.5 only knows the Windows names of a handful of timezones
+EWSTimeZone.PYTZ_TO_MS_MAP.setdefault('America/Chicago', 'Central Standard Time')
+
+
+class AutodiscoverCache:
+    """
+    JSON file of what autodiscover found for each mailbox: its primary SMTP address, EWS endpoint and auth type.
+    Entries are used for ttl seconds.
+    """
+
+    def __init__(self, path=AUTODISCOVER_CACHE_FILE, ttl=AUTODISCOVER_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            handle, temporary_path = tempfile.mkstemp(dir=cache_dir or None)
+            with os.fdopen(handle, 'w') as cache_file:
+                json.dump(entries, cache_file, indent=2, sort_keys=True)
+            os.replace(temporary_path, self.path)
+        except (IOError, OSError) as error:
+            print("Could not cache Exchange autodiscover results in {path}: {error}".format(path=self.path,
+                                                                                           error=error))
+
+    def get(self, email):
+        with self.lock:
+            entry = self._load().get(email.lower())
+        if entry is None or time.time() - entry['discovered'] > self.ttl:
+            return None
+        return entry
+
+    def set(self, email, primary_smtp_address, protocol):
+        with self.lock:
+            entries = self._load()
+            entries[email.lower()] = {
+                'primary_smtp_address': primary_smtp_address,
+                'service_endpoint': protocol.service_endpoint,
+                'auth_type': protocol.auth_type,
+                'discovered': time.time(),
+            }
+            self._save(entries)
+
+    def remove(self, email):
+        with self.lock:
+            entries = self._load()
+            if entries.pop(email.lower(), None) is not None:
+                self._save(entries)
+
+
+autodiscover_cache = AutodiscoverCache()
+
+
+class ExchangeAccounts:
+    """
+    Delegate Exchange accounts, created once per mailbox. Autodiscover takes several seconds, so its results are kept
+    in autodiscover_cache and later runs connect straight to the cached endpoint with the cached auth type.
+    """
+
+    def __init__(self, username, password):
+        self.credentials = Credentials(username=username, password=password)
+        self.accounts = {}
+        self.lock = threading.Lock()
+
+    def account(self, primary_smtp_address):
+        with self.lock:
+            if primary_smtp_address not in self.accounts:
+                self.accounts[primary_smtp_address] = self._connect(primary_smtp_address)
+            return self.accounts[primary_smtp_address]
+
+    def _connect(self, primary_smtp_address):
+        cached = autodiscover_cache.get(primary_smtp_address)
+        if cached is not None:
+            try:
+                protocol = Protocol(service_endpoint=cached['service_endpoint'], credentials=self.credentials,
+                                    auth_type=cached['auth_type'], verify_ssl=True)
+                return Account(primary_smtp_address=cached['primary_smtp_address'], credentials=self.credentials,
+                               access_type=DELEGATE, config=DiscoveredConfiguration(protocol))
+            except EWSError as error:
+                print("Could not connect to the cached Exchange endpoint for {address}, will autodiscover it again: "
+                      "{error}".format(address=primary_smtp_address, error=error))
+                autodiscover_cache.remove(primary_smtp_address)
+
+        account = Account(primary_smtp_address=primary_smtp_address, credentials=self.credentials, autodiscover=True,
+                          access_type=DELEGATE)
+        autodiscover_cache.set(primary_smtp_address, account.primary_smtp_address, account.protocol)
+        return account
+
+
+def create_outlook_calendar_events(appointments, outlook_calendar_service):
+    synced, failed = sync_outlook_calendar_events(appointments, [], outlook_calendar_service)
+    return len(synced)
+
+
+def sync_outlook_calendar_events(appointments, recorded_events, outlook_calendar_service):
+    """
+    Makes an Exchange calendar match the appointments, given the events previously recorded as made for them. Recorded
+    events are moved with one update_items call, or one call each if that fails, and deleted with one delete_items
+    call. A moved event that is gone is created again along with the new appointments, which are created with one
+    add_items call per CreateItem chunk unless the calendar, searched once for their whole span, already has a
+    matching event.
+
+    Returns the {appointment: SyncedEvent} of every appointment now on the calendar and the recorded events that could
+    not be moved or deleted.
+    """
+    synced, moves, new, stale = diff_synced_events(appointments, recorded_events)
+    failed = []
+    calendar = outlook_calendar_service.calendar
+    ews_tz = EWSTimeZone.timezone('America/Chicago')
+
+    if moves:
+        updates = [outlook_calendar_move(event, appointment, ews_tz) for event, appointment, summary in moves]
+        try:
+            ids = throttling.call('exchange', lambda: calendar.update_items(updates),
+                                  retry_on=EXCHANGE_THROTTLING_ERRORS, endpoint='exchange.update_items',
+                                  items=len(updates))
+        except EWSError:
+            # one event that is gone fails the whole call, so the events are moved one at a time instead
+            for event, appointment, summary in moves:
+                try:
+                    ids = throttling.call('exchange', lambda: calendar.update_items(
+                        [outlook_calendar_move(event, appointment, ews_tz)]),
+                        retry_on=EXCHANGE_THROTTLING_ERRORS, endpoint='exchange.update_items')
+                except ErrorItemNotFound:
+                    print("Outlook calendar event {event} is gone, will create appointment {app} again".format(
+                        event=event, app=appointment))
+                    new.append((appointment, summary))
+                except EWSError as error:
+                    print("Could not move Outlook calendar event {event}: {error}".format(event=event, error=error))
+                    failed.append(event)
+                else:
+                    print('Outlook calendar event moved to appointment {app}'.format(app=appointment))
+                    synced[appointment] = synced_event(ids[0][0], ids[0][1], summary, appointment)
+        else:
+            for (event, appointment, summary), (item_id, change_key) in zip(moves, ids):
+                print('Outlook calendar event moved to appointment {app}'.format(app=appointment))
+                synced[appointment] = synced_event(item_id, change_key, summary, appointment)
+
+    if new:
+        start = ews_date_time(min(appointment.start_time for appointment, summary in new), ews_tz)
+        end = ews_date_time(max(appointment.end_time for appointment, summary in new), ews_tz)
+        existing_events = outlook_calendar_events_index(outlook_calendar_service, start, end)
+
+        new_events = []
+        for appointment, summary in new:
+            key = calendar_event_key(summary, appointment.start_time, appointment.end_time)
+            if key in existing_events:
+                print("Found a matching Outlook calendar event for appointment {app}. Will not create a new one."
+                      .format(app=appointment))
+                item_id, change_key = existing_events[key]
+                synced[appointment] = synced_event(item_id, change_key, summary, appointment)
+            else:
+                new_events.append((appointment, summary, outlook_calendar_event(appointment, summary, ews_tz)))
+
+        # add_items sends a CreateItem request per CHUNKSIZE items, so a throttled retry of more than one chunk would
+        # create the chunks that already succeeded twice
+        for i in range(0, len(new_events), CreateItem.CHUNKSIZE):
+            chunk = new_events[i:i + CreateItem.CHUNKSIZE]
+            ids = throttling.call('exchange', lambda: calendar.add_items([event for a, s, event in chunk]),
+                                  retry_on=EXCHANGE_THROTTLING_ERRORS, endpoint='exchange.add_items',
+                                  items=len(chunk))
+            for (appointment, summary, event), (item_id, change_key) in zip(chunk, ids):
+                print('Outlook calendar event created. Details: {0}'.format(event))
+                synced[appointment] = synced_event(item_id, change_key, summary, appointment)
+
+    if stale:
+        failed.extend(delete_outlook_calendar_events(calendar, stale))
+
+    return synced, failed
+
+
+def delete_outlook_calendar_events(calendar, events):
+    """
+    Deletes the events with one delete_items call, falling back to one call per event if the bulk call fails so a
+    single event that is already gone doesn't keep the others around. Returns the events that could not be deleted.
+    """
+    try:
+        throttling.call('exchange', lambda: calendar.delete_items([(event.event_id, event.change_key)
+                                                                   for event in events]),
+                        retry_on=EXCHANGE_THROTTLING_ERRORS, endpoint='exchange.delete_items', items=len(events))
+    except EWSError:
+        failed = []
+        for event in events:
+            try:
+                throttling.call('exchange', lambda: calendar.delete_items([(event.event_id, event.change_key)]),
+                                retry_on=EXCHANGE_THROTTLING_ERRORS, endpoint='exchange.delete_items')
+            except ErrorItemNotFound:
+                pass
+            except EWSError as error:
+                print("Could not delete Outlook calendar event {event}: {error}".format(event=event, error=error))
+                failed.append(event)
+                continue
+            print('Outlook calendar event deleted. Details: {0}'.format(event))
+        return failed
+
+    for event in events:
+        print('Outlook calendar event deleted. Details: {0}'.format(event))
+    return []
+
+
+def ews_date_time(time, ews_tz):
+    d = time.datetime
+    return EWSDateTime.from_datetime(datetime(d.year, d.month, d.day, d.hour, d.minute, d.second, d.microsecond,
+                                              ews_tz))
+
+
+def outlook_calendar_events_index(calendar_service, start, end):
+    """
+    Finds every calendar item overlapping start and end and returns {calendar_event_key: (item ID, change key)}. Only
+    the subject, start and end of each item are requested instead of the AllProperties shape.
+    """
+    calendar = calendar_service.calendar
+    restriction = Restriction.from_params(start=start, end=end)
+    items = throttling.call('exchange', lambda: FindItem(calendar.account.protocol).call(
+        folder=calendar, additional_fields=OUTLOOK_COMPARED_FIELDS, restriction=restriction, shape=IdOnly),
+        retry_on=EXCHANGE_THROTTLING_ERRORS, endpoint='exchange.find_items')
+    index = {}
+    for item in items:
+        event = CalendarItem.from_xml(item)
+        if event.start and event.end:
+            index[calendar_event_key(event.subject, event.start, event.end)] = (event.item_id, event.changekey)
+
+    return index
+
+
+def outlook_calendar_move(event, appointment, ews_tz):
+    return (event.event_id, event.change_key), {'start': ews_date_time(appointment.start_time, ews_tz),
+                                                'end': ews_date_time(appointment.end_time, ews_tz)}
+
+
+def outlook_calendar_event(appointment, summary, ews_tz):
+    return CalendarItem(
+        subject=summary,
+        body=EVENT_DESCRIPTION,
+        start=ews_date_time(appointment.start_time, ews_tz),
+        end=ews_date_time(appointment.end_time, ews_tz)
+    )
@@ -0,0 +1,156 @@
+import csv
+import os
+import threading
+from collections import OrderedDict
+
+from appointments import tab_name, NameIndex
+
+# Schedule sources other than the Google spreadsheet. Like SheetSnapshot they have cells(day), which returns the rows
+# of the day's tab as lists of cell values or None if there is no such tab, prefetch(days), PREFETCH_DAYS, the most
+# days worth prefetching at once, name_index(day), which returns the tab's NameIndex, and close(), which releases any
+# open files once a sync is done, so the same parsing runs against any of them.
+
+# The same A1:CC100 block SheetSnapshot reads from each tab
+SCHEDULE_ROWS = 100
+SCHEDULE_COLUMNS = 81
+# Local tabs are cheap to read again, so only the tabs of a couple of pipeline chunks are kept in memory
+CACHED_TABS = 14
+
+
+class LocalSnapshot:
+    """
+    Reads day tabs from local files on demand, keeping only the CACHED_TABS most recently used in memory so a whole
+    quarter can be processed without holding every tab at once.
+    """
+
+    # half the cache, so the tabs being parsed stay cached while the next ones are read
+    PREFETCH_DAYS = CACHED_TABS // 2
+
+    def __init__(self):
+        self.tabs = OrderedDict()
+        self.name_indexes = {}
+        self.lock = threading.RLock()
+        # name indexes are built under their own lock, so parsing one day never waits for the reader to load another
+        self.index_lock = threading.Lock()
+
+    def cells(self, day):
+        tab = tab_name(day)
+        with self.lock:
+            if tab in self.tabs:
+                self.tabs.move_to_end(tab)
+                return self.tabs[tab]
+
+            cells = self._read(tab)
+            if cells is None:
+                print("Could not find cells for tab {0}".format(tab))
+            self.tabs[tab] = cells
+            while len(self.tabs) > CACHED_TABS:
+                evicted_tab, _ = self.tabs.popitem(last=False)
+                with self.index_lock:
+                    self.name_indexes.pop(evicted_tab, None)
+            return cells
+
+    def name_index(self, day):
+        tab = tab_name(day)
+        cells = self.cells(day)
+        with self.index_lock:
+            if tab in self.name_indexes:
+                return self.name_indexes[tab]
+            index = None if cells is None else NameIndex(cells)
+            # a tab evicted in the meantime would otherwise keep its index forever
+            if tab in self.tabs:
+                self.name_indexes[tab] = index
+            return index
+
+    def prefetch(self, days):
+        for day in days:
+            self.cells(day)
+
+    def close(self):
+        pass
+
+    def _read(self, tab):
+        raise NotImplementedError
+
+
+def schedule_row(values):
+    """
+    Turns cell values into the strings the Sheets API would return, without the trailing empty cells it leaves out.
+    """
+    row = ['' if value is None else str(value) for value in values[:SCHEDULE_COLUMNS]]
+    while row and row[-1] == '':
+        row.pop()
+    return row
+
+
+class CsvDirectorySnapshot(LocalSnapshot):
+    """
+    Directory of CSV exports, one per day tab, each named after its tab, such as "Mon 01.02.17.csv".
+    """
+
+    def __init__(self, directory):
+        LocalSnapshot.__init__(self)
+        self.directory = directory
+
+    def _read(self, tab):
+        path = os.path.join(self.directory, tab + '.csv')
+        if not os.path.exists(path):
+            return None
+
+        rows = []
+        with open(path, newline='', encoding='utf-8') as csv_file:
+            for values in csv.reader(csv_file):
+                rows.append(schedule_row(values))
+                if len(rows) == SCHEDULE_ROWS:
+                    break
+        return rows
+
+
+class XlsxSnapshot(LocalSnapshot):
+    """
+    XLSX workbook, such as the schedule spreadsheet downloaded from Google Sheets, with one worksheet per day tab.
+    The workbook is opened read-only, so openpyxl streams each worksheet's rows from the file instead of loading the
+    whole workbook.
+    """
+
+    def __init__(self, path):
+        LocalSnapshot.__init__(self)
+        # only needed for XLSX schedules, so it isn't required to sync from Google Sheets
+        import openpyxl
+
+        self.path = path
+        self.workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+
+    def close(self):
+        # openpyxl 2.4 has no Workbook.close, a read-only workbook keeps its file open in _archive. On Windows the
+        # open file would keep the next export from replacing the workbook.
+        self.workbook._archive.close()
+
+    def _read(self, tab):
+        if tab not in self.workbook.sheetnames:
+            return None
+
+        worksheet = self.workbook[tab]
+        return [schedule_row([cell.value for cell in cells])
+                for cells in worksheet.iter_rows(min_row=1, max_row=SCHEDULE_ROWS, min_col=1,
+                                                 max_col=SCHEDULE_COLUMNS)]
+
+
+def open_schedule(path):
+    """
+    Opens a local schedule: an .xlsx workbook, or a directory of per-day CSV files.
+    """
+    if os.path.isdir(path):
+        return CsvDirectorySnapshot(path)
+    return XlsxSnapshot(path)
+
+
+def schedule_modified_time(path):
+    """
+    When the local schedule at path last changed, as a UNIX timestamp.
+    """
+    if os.path.isdir(path):
+        # the directory's own time changes when a day's file is added, removed or renamed
+        return max([os.path.getmtime(path)] +
+                   [os.path.getmtime(os.path.join(path, name)) for name in os.listdir(path) if name.endswith('.csv')])
+    return os.path.getmtime(path)
@@ -0,0 +1,68 @@
+"""
+Smoke check for the scripts' real Google credential loading, which benchmark.py patches out.
+
+Imports every script and has each one's get_credentials load a stored token from a temporary home directory, so a
+missing import or a changed scope check fails here instead of on the first real run:
+
+    python smoke_check.py
+"""
+import argparse
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+
+# oauth2client.file is deliberately not imported here, the scripts have to import it themselves
+from oauth2client import client
+from oauth2client import tools
+
+import appointments
+
+SCRIPTS = ['frontline_calendar', 'lunchtime', 'staffing_report']
+
+
+def store_credentials(home_dir):
+    """
+    Stores a token for SCOPES where get_credentials looks for it, so no authorization flow is started.
+    """
+    credential_dir = os.path.join(home_dir, '.credentials')
+    os.makedirs(credential_dir)
+    credentials = client.OAuth2Credentials('access-token', 'client-id', 'client-secret', 'refresh-token', None,
+                                           'https://oauth2.googleapis.com/token', 'smoke-check',
+                                           scopes=appointments.SCOPES)
+    with open(os.path.join(credential_dir, 'drive-python-frontline-calendar.json'), 'w') as credential_file:
+        credential_file.write(credentials.to_json())
+
+
+def main():
+    flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args([])
+
+    home_dir = tempfile.mkdtemp(prefix='frontline-smoke-')
+    environment = dict(os.environ)
+    # expanduser reads HOME everywhere and USERPROFILE on Windows
+    os.environ['HOME'] = os.environ['USERPROFILE'] = home_dir
+    failures = []
+    try:
+        store_credentials(home_dir)
+        for name in SCRIPTS:
+            try:
+                script = importlib.import_module(name)
+                credentials = script.get_credentials(flags)
+                if credentials is None or credentials.invalid:
+                    raise ValueError('no valid credentials loaded')
+            except Exception as error:
+                failures.append(name)
+                print("{name}: FAILED {error!r}".format(name=name, error=error))
+            else:
+                print("{name}: ok".format(name=name))
+    finally:
+        os.environ.clear()
+        os.environ.update(environment)
+        shutil.rmtree(home_dir)
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+from appointments import TIME_BLOCK_CELLS, TIME_BLOCK_FIRST_COLUMN, TIME_BLOCK_LAST_COLUMN, cell_runs, rows_for_names
+from metrics import recorder, date_label
+
+# Coverage is counted in a single pass over each day tab: every row is run-length encoded once and each run adds one
+# to the slots it covers, so the whole team's matrix costs no more to build than reading the tabs.
+
+# Cell types whose staffing is counted
+COVERAGE_TYPES = ['F', 'C']
+
+
+def day_coverage(cells, rows, coverage_types):
+    """
+    Counts how many of the given rows have each coverage type in each time block cell of a day tab. Returns
+    {type: [count per cell]}.
+    """
+    counts = dict((coverage_type, [0] * TIME_BLOCK_CELLS) for coverage_type in coverage_types)
+    for row in rows:
+        for run in cell_runs(cells[row - 1][TIME_BLOCK_FIRST_COLUMN:TIME_BLOCK_LAST_COLUMN + 1]):
+            if run.appointment_type in counts:
+                type_counts = counts[run.appointment_type]
+                for i in range(run.start_cell, run.end_cell):
+                    type_counts[i] += 1
+    return counts
+
+
+def coverage_matrix(snapshot, dates, coverage_types=COVERAGE_TYPES, names=None):
+    """
+    Reads each date's tab once and counts the people on each coverage type in every 15 minute slot. Everyone on a
+    tab is counted unless names is given. Prefetch the dates first to read their tabs in bulk. Returns (date,
+    {type: [count per cell]}) pairs in date order, leaving out dates whose tab could not be read.
+    """
+    matrix = []
+    for date in dates:
+        with recorder.phase('coverage', date_label([date])):
+            cells = snapshot.cells(date)
+            if cells is None:
+                continue
+
+            if names is None:
+                rows = range(1, len(cells) + 1)
+            else:
+                rows = rows_for_names(snapshot, names, date).values()
+            matrix.append((date, day_coverage(cells, rows, coverage_types)))
+
+    return matrix
+
+
+def staffing_gaps(matrix, minimums, maximums):
+    """
+    Finds the runs of slots where a coverage type has fewer people than minimums[type] or more than maximums[type].
+    Returns (date, type, start_cell, end_cell, count, threshold) tuples, where threshold is the minimum or maximum
+    that was crossed, with consecutive slots that have the same count merged.
+    """
+    gaps = []
+    for date, counts in matrix:
+        for coverage_type in sorted(counts):
+            type_counts = counts[coverage_type]
+            start = 0
+            for i in range(1, TIME_BLOCK_CELLS + 1):
+                if i < TIME_BLOCK_CELLS and type_counts[i] == type_counts[start]:
+                    continue
+
+                count = type_counts[start]
+                if coverage_type in minimums and count < minimums[coverage_type]:
+                    gaps.append((date, coverage_type, start, i, count, minimums[coverage_type]))
+                elif coverage_type in maximums and count > maximums[coverage_type]:
+                    gaps.append((date, coverage_type, start, i, count, maximums[coverage_type]))
+                start = i
+
+    return gaps
@@ -0,0 +1,93 @@
+import argparse
+import csv
+import sys
+
+import arrow
+import google_services
+from appointments import get_credentials, time_from_cell_index, SheetSnapshot, TIME_BLOCK_CELLS
+from metrics import recorder, date_label
+from oauth2client import tools
+from staffing import coverage_matrix, staffing_gaps, COVERAGE_TYPES
+
+# Staffing each coverage type needs in every slot unless --minimum says otherwise
+DEFAULT_MINIMUMS = ['F=1', 'C=1']
+
+
+def thresholds(values):
+    """
+    Parses TYPE=COUNT flag values into {type: count}.
+    """
+    parsed = {}
+    for value in values or []:
+        coverage_type, _, count = value.partition('=')
+        parsed[coverage_type] = int(count)
+    return parsed
+
+
+def write_matrix_csv(matrix, path):
+    """
+    Writes one row per date and coverage type with the number of people in each slot, headed by the slot start times.
+    """
+    with open(path, 'w', newline='') as matrix_file:
+        writer = csv.writer(matrix_file)
+        start = arrow.get(0).floor('day')
+        writer.writerow(['date', 'type'] + [time_from_cell_index(i, start).format('HH:mm')
+                                            for i in range(0, TIME_BLOCK_CELLS)])
+        for date, counts in matrix:
+            for coverage_type in sorted(counts):
+                writer.writerow([date.format('YYYY-MM-DD'), coverage_type] + counts[coverage_type])
+
+
+def main():
+    parser = argparse.ArgumentParser(parents=[tools.argparser])
+    parser.add_argument('--date', help='What date to start looking at the calendar? Use format YYYY-MM-DD.')
+    parser.add_argument('--look_ahead_days', help='How many days to look ahead from the starting date?')
+    parser.add_argument('--names', nargs='+', help='Only count these people, instead of everyone on the schedule')
+    parser.add_argument('--coverage_types', nargs='+', default=COVERAGE_TYPES,
+                        help='Which schedule cell types to count staffing for?')
+    parser.add_argument('--minimum', nargs='+', default=DEFAULT_MINIMUMS,
+                        help='Fewest people each type needs in a slot, as TYPE=COUNT such as F=2')
+    parser.add_argument('--maximum', nargs='+', help='Most people a type should have in a slot, as TYPE=COUNT')
+    parser.add_argument('--matrix_csv', help='Also write the full people per slot matrix to this CSV file')
+    parser.add_argument('--spreadsheet_id', help='The ID of the ECBU Luminate Support Weekly Schedule spreadsheet',
+                        default='1RgDgDRcyAFDdkEyRH7m_4QOtJ7e-kv324hEWE4JuwgI')
+    parser.add_argument('--schedule_file', help='Read the schedule from an exported .xlsx workbook, or a directory of '
+                                                'per-day CSV files named after their tabs, instead of the spreadsheet')
+    parser.add_argument('--metrics', help='Write API call and phase timing metrics as JSON to this file, or - for '
+                                          'standard output')
+
+    flags = parser.parse_args()
+
+    print("Running with args: " + str(sys.argv))
+
+    today = arrow.get(flags.date, 'YYYY-MM-DD')
+    dates = [today.replace(days=+n) for n in range(0, int(flags.look_ahead_days))]
+
+    if flags.schedule_file:
+        from schedule_sources import open_schedule
+        snapshot = open_schedule(flags.schedule_file)
+    else:
+        http = google_services.HttpPool(get_credentials(flags))
+        snapshot = SheetSnapshot(google_services.build('sheets', 'v4', http=http), flags.spreadsheet_id)
+    with recorder.phase('prefetch', date_label(dates or [today])):
+        snapshot.prefetch(dates)
+
+    matrix = coverage_matrix(snapshot, dates, flags.coverage_types, flags.names)
+    minimums = thresholds(flags.minimum)
+    maximums = thresholds(flags.maximum)
+
+    for date, coverage_type, start, end, count, threshold in staffing_gaps(matrix, minimums, maximums):
+        midnight = arrow.Arrow(date.year, date.month, date.day, tzinfo='America/Chicago')
+        print("{day} {start}-{end} {type}: {count} on, {verdict} {threshold}".format(
+            day=date.strftime("%a %m.%d.%y"), start=time_from_cell_index(start, midnight).format('HH:mm'),
+            end=time_from_cell_index(end, midnight).format('HH:mm'), type=coverage_type, count=count,
+            verdict='need' if count < minimums.get(coverage_type, 0) else 'at most', threshold=threshold))
+
+    if flags.matrix_csv:
+        write_matrix_csv(matrix, flags.matrix_csv)
+
+    if flags.metrics:
+        recorder.write(flags.metrics)
+
+if __name__ == "__main__":
+    main()
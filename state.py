@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+
+STATE_FILE = os.path.join(os.path.expanduser('~'), '.frontline_calendar', 'state.sqlite')
+
+# An event we put on a calendar. start and end are UNIX timestamps, change_key is only used by Exchange.
+SyncedEvent = namedtuple('SyncedEvent', ['event_id', 'change_key', 'summary', 'start', 'end'])
+
+
+def cells_hash(time_blocks):
+    return hashlib.sha1(json.dumps(time_blocks).encode('utf-8')).hexdigest()
+
+
+class StateStore:
+    """
+    SQLite record of what was last synced to each calendar backend for every (person, date): a hash of the row's K:BF
+    cells and the events we made for it. Days whose hash hasn't changed are skipped, and changed days are diffed
+    against the recorded events instead of the calendar.
+    """
+
+    def __init__(self, path=STATE_FILE):
+        state_dir = os.path.dirname(path)
+        if state_dir and not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+
+        # calendar writes run on worker threads, which share this connection one at a time
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS days ('
+                                    'person TEXT, date TEXT, backend TEXT, cells_hash TEXT, '
+                                    'PRIMARY KEY (person, date, backend))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS events ('
+                                    'person TEXT, date TEXT, backend TEXT, event_id TEXT, change_key TEXT, '
+                                    'summary TEXT, start INTEGER, end INTEGER)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS events_by_day ON events (person, date, backend)')
+
+    def cells_hash(self, person, date, backend):
+        with self.lock:
+            row = self.connection.execute('SELECT cells_hash FROM days WHERE person = ? AND date = ? AND backend = ?',
+                                          (person, date, backend)).fetchone()
+        return row[0] if row else None
+
+    def events(self, person, date, backend):
+        with self.lock:
+            rows = self.connection.execute('SELECT event_id, change_key, summary, start, end FROM events '
+                                           'WHERE person = ? AND date = ? AND backend = ?',
+                                           (person, date, backend)).fetchall()
+        return [SyncedEvent(*row) for row in rows]
+
+    def record_day(self, person, date, backend, day_cells_hash, events):
+        """
+        Replaces everything recorded for the day with its new cells hash and the events now on the calendar for it.
+        """
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO days (person, date, backend, cells_hash) '
+                                    'VALUES (?, ?, ?, ?)', (person, date, backend, day_cells_hash))
+            self.connection.execute('DELETE FROM events WHERE person = ? AND date = ? AND backend = ?',
+                                    (person, date, backend))
+            self.connection.executemany('INSERT INTO events (person, date, backend, event_id, change_key, summary, '
+                                        'start, end) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                        [(person, date, backend) + tuple(event) for event in events])
+
+    def close(self):
+        self.connection.close()
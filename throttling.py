@@ -0,0 +1,105 @@
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+import metrics
+
+# (requests per second, burst size) per backend, kept under the per-user quotas of each API
+RATE_LIMITS = {
+    'sheets': (1.0, 10),
+    'drive': (1.0, 5),
+    'calendar': (10.0, 50),
+    'exchange': (2.0, 4),
+}
+
+# HTTP statuses Google uses for quota and overload errors that are worth retrying
+RETRY_STATUSES = (429, 503)
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1.0
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Taking more tokens than are available puts the bucket into debt, and the caller sleeps
+    until the debt would have been refilled, so batches larger than the burst size are still paced correctly.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+limiters = dict((backend, TokenBucket(rate, capacity)) for backend, (rate, capacity) in RATE_LIMITS.items())
+
+
+def is_retryable(error, retry_on=()):
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRY_STATUSES
+    return isinstance(error, retry_on)
+
+
+def backoff(attempt):
+    """
+    Sleeps for an exponentially growing, jittered delay before retry number attempt + 1.
+    """
+    time.sleep(BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random()))
+
+
+def call(backend, function, retry_on=(), tokens=1, endpoint=None, items=None):
+    """
+    Calls function once the backend's rate limit allows it, retrying quota and overload errors with exponential
+    backoff. retry_on lists any extra exception types, such as Exchange throttling errors, that should be retried.
+
+    Every call is recorded in metrics.recorder under endpoint, which defaults to the backend's name, along with the
+    number of items it carried, which defaults to tokens.
+    """
+    latencies = []
+    waited = 0.0
+    attempt = 0
+    while True:
+        waiting = time.time()
+        limiters[backend].acquire(tokens)
+        started = time.time()
+        waited += started - waiting
+        try:
+            result = function()
+        except Exception as error:
+            latencies.append(time.time() - started)
+            if attempt >= MAX_RETRIES or not is_retryable(error, retry_on):
+                metrics.recorder.record_call(endpoint or backend, latencies, tokens if items is None else items,
+                                             attempt, waited, type(error).__name__)
+                raise
+            print("{backend} is throttling us ({error}), retrying".format(backend=backend, error=error))
+            waiting = time.time()
+            backoff(attempt)
+            waited += time.time() - waiting
+            attempt += 1
+            continue
+
+        latencies.append(time.time() - started)
+        metrics.recorder.record_call(endpoint or backend, latencies, tokens if items is None else items, attempt,
+                                     waited, 'ok')
+        return result
+
+
+def execute(request, backend, items=1):
+    """
+    Executes a googleapiclient request under the backend's rate limit, recording it under the request's method ID.
+    """
+    return call(backend, request.execute, endpoint=getattr(request, 'methodId', None), items=items)